@@ -0,0 +1,80 @@
+# synthetic source files for benchmarking the alignment
+import random
+
+
+# scopes of the generated languages
+SCOPES = {
+    'python':  'source.python',
+    'fortran': 'source.modern-fortran',
+    'json':    'source.json'
+}
+
+NAMES = ['i', 'n', 'idx', 'value', 'count', 'result', 'max_iter', 'tolerance', 'x_min', 'boundary_layer']
+TYPES = ['integer', 'real(dp)', 'logical', 'character(len=32)', 'real(dp), dimension(:)']
+
+
+def get_name(rand):
+    return rand.choice(NAMES) + rand.choice(['', '_' + str(rand.randint(0, 99))])
+
+
+def get_spaces(rand):
+    # unaligned lines have a random number of spaces around alignment characters
+    return ' ' * rand.randint(0, 3)
+
+
+def get_python_line(rand, indent):
+    kind = rand.random()
+    if kind < 0.1:
+        return indent + 'from package.module_{0} import {1}{2}as {3}'.format(rand.randint(0, 9), get_name(rand), get_spaces(rand) + ' ', get_name(rand))
+    if kind < 0.2:
+        return indent + '{0!r}{1}: {2},'.format(get_name(rand), get_spaces(rand), rand.randint(0, 1000))
+    line = indent + get_name(rand) + get_spaces(rand) + rand.choice(['=', '+=', '*=']) + ' ' + get_name(rand) + '(' + get_name(rand) + '=1)'
+    if rand.random() < 0.5:
+        line += get_spaces(rand) + '  # ' + get_name(rand)
+    return line
+
+
+def get_fortran_line(rand, indent):
+    kind = rand.random()
+    if kind < 0.4:
+        line = indent + rand.choice(TYPES) + rand.choice(['', ', intent(in)', ', intent(inout)']) + get_spaces(rand) + ':: ' + get_name(rand)
+    elif kind < 0.5:
+        return indent + get_name(rand) + get_spaces(rand) + '=> ' + get_name(rand) + '%' + get_name(rand)
+    else:
+        line = indent + get_name(rand) + '(i)' + get_spaces(rand) + '= ' + get_name(rand) + '(i) * 0.5_dp'
+        if rand.random() < 0.2:
+            line += get_spaces(rand) + ' &'
+    if rand.random() < 0.3:
+        line += get_spaces(rand) + ' ! ' + get_name(rand)
+    return line
+
+
+def get_json_line(rand, indent):
+    value = rand.choice([str(rand.randint(0, 1000)), '"' + get_name(rand) + '"', 'true', 'null', '[1, 2, 3]'])
+    return indent + '"{0}"{1}: {2},'.format(get_name(rand), get_spaces(rand), value)
+
+
+LINE_GENERATORS = {
+    'python':  get_python_line,
+    'fortran': get_fortran_line,
+    'json':    get_json_line
+}
+
+
+def generate_lines(language, line_cnt, seed=0):
+    # blocks of random size separated by empty lines or changes of the indentation level
+    rand     = random.Random(seed)
+    get_line = LINE_GENERATORS[language]
+    lines    = []
+    while len(lines) < line_cnt:
+        indent = '    ' * rand.randint(0, 3)
+        for _ in range(rand.randint(2, 40)):
+            lines.append(get_line(rand, indent))
+        if rand.random() < 0.5:
+            lines.append('')
+    return lines[:line_cnt]
+
+
+def generate_align_chars(rule_cnt):
+    # keyword rules which rarely match to increase the size of the overall regex
+    return [{'char': ' keyword_{0} '.format(i), 'alignment': 'left'} for i in range(rule_cnt)]
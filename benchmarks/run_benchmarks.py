@@ -0,0 +1,149 @@
+# benchmark of the multialign command on synthetic corpora
+#
+#     python benchmarks/run_benchmarks.py [--sizes 1000 10000] [--json results.json] [--compare baseline.json]
+#
+import argparse
+import json
+import os
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0]  = [os.path.join(BENCHMARK_DIR, 'stubs'), os.path.dirname(BENCHMARK_DIR)]
+
+import sublime
+import multialign
+import multialign_engine
+import corpora
+
+
+# stages of the command which are timed individually (name, class, method), the edit plan
+# is applied through apply_alignment or directly when aligning all blocks
+STAGES = [
+    ('find_matches', multialign_engine.AlignmentEngine, 'find_matches_in_all_selections'),
+    ('check',        multialign_engine.AlignmentEngine, 'check_alignment_to_be_made'),
+    ('apply',        multialign.multialignCommand,      'apply_edit_plan')
+]
+
+COLUMNS = ['find_matches', 'check', 'apply', 'setup', 'total']
+
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.timings = {}
+
+    def wrap(self, name, method):
+        def timed_method(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+        return timed_method
+
+    def __enter__(self):
+        self.methods = [(cls, method_name, getattr(cls, method_name)) for name, cls, method_name in STAGES]
+        for name, cls, method_name in STAGES:
+            setattr(cls, method_name, self.wrap(name, getattr(cls, method_name)))
+        return self
+
+    def __exit__(self, *exc_info):
+        for cls, method_name, method in self.methods:
+            setattr(cls, method_name, method)
+
+
+def get_cursor_points(view, lines, cursor_cnt):
+    # cursors spread evenly over the non-empty rows at the beginning of the text
+    rows = [row for row, line in enumerate(lines) if line.strip()]
+    step = max(1, len(rows) // cursor_cnt)
+    return [view.text_point(row, len(lines[row]) - len(lines[row].lstrip())) for row in rows[::step][:cursor_cnt]]
+
+
+def run_case(lines, scope, settings, cursor_cnt, repeat):
+    text = '\n'.join(lines)
+    best = None
+    for _ in range(repeat):
+        view = sublime.View(text, scope, settings)
+        if cursor_cnt:
+            for point in get_cursor_points(view, lines, cursor_cnt):
+                view.sel().add(sublime.Region(point))
+        else:
+            view.sel().add(sublime.Region(0))
+
+        with StageTimer() as stage_timer:
+            start = time.perf_counter()
+            multialign.multialignCommand(view).run(None, all_blocks=not cursor_cnt)
+            total = time.perf_counter() - start
+
+        # the setup covers loading settings, compiling the rules and everything not timed separately
+        timings          = dict((name, stage_timer.timings.get(name, 0.0)) for name, cls, method_name in STAGES)
+        timings['setup'] = total - sum(timings.values())
+        timings['total'] = total
+        if best is None or total < best['total']:
+            best = timings
+    return best
+
+
+def get_cases(args):
+    for language in args.languages:
+        for size in args.sizes:
+            lines = corpora.generate_lines(language, size, args.seed)
+            for rule_cnt in args.rules:
+                settings = {
+                    'tab_size':                   4,
+                    'translate_tabs_to_spaces':   True,
+                    'multiAlign_async_threshold': 0,
+                    'multiAlign_align_chars':     multialign_engine.DEFAULT_ALIGN_CHARS + corpora.generate_align_chars(rule_cnt)
+                }
+                for cursor_cnt in args.cursors + ([0] if args.all_blocks else []):
+                    yield {'language': language, 'size': size, 'rules': rule_cnt, 'cursors': cursor_cnt}, lines, settings
+
+
+def get_case_key(case):
+    return '{language}/{size}/{rules}/{cursors}'.format(**case)
+
+
+def format_row(case, timings, baseline):
+    row = '{language:8} {size:>7} {rules:>5} {cursors:>7}'.format(**case)
+    row += ''.join('{0:>16.2f}'.format(timings[column] * 1000) for column in COLUMNS)
+    if baseline:
+        row += '{0:>9.2f}x'.format(timings['total'] / baseline['total'] if baseline['total'] else 0.0)
+    return row
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the multialign command on synthetic corpora.')
+    parser.add_argument('--languages', nargs='+', default=sorted(corpora.SCOPES), choices=sorted(corpora.SCOPES))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000], help='number of lines of the corpora')
+    parser.add_argument('--cursors', nargs='+', type=int, default=[1, 10, 100], help='number of cursors spread over the corpora')
+    parser.add_argument('--rules', nargs='+', type=int, default=[0, 32], help='number of rules added to the default rules')
+    parser.add_argument('--all-blocks', action='store_true', help='additionally align all blocks of the corpora (cursors 0)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of which the fastest is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the results to a JSON file')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare the total times with')
+    args = parser.parse_args(argv)
+
+    baselines = {}
+    if args.compare:
+        with open(args.compare) as compare_file:
+            baselines = json.load(compare_file)
+
+    header = '{0:8} {1:>7} {2:>5} {3:>7}'.format('language', 'lines', 'rules', 'cursors') + ''.join('{0:>16}'.format(column + ' ms') for column in COLUMNS)
+    print(header + ('   vs base' if baselines else ''))
+
+    results = {}
+    for case, lines, settings in get_cases(args):
+        timings                      = run_case(lines, corpora.SCOPES[case['language']], settings, case['cursors'], args.repeat)
+        results[get_case_key(case)] = timings
+        print(format_row(case, timings, baselines.get(get_case_key(case))))
+        sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+# in-memory replacement of the parts of the Sublime Text API used by the plugin
+import bisect
+
+
+class Region(object):
+
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def empty(self):
+        return self.a == self.b
+
+
+class Settings(object):
+
+    def __init__(self, values=None):
+        self.values    = dict(values or {})
+        self.callbacks = {}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+        for callback in list(self.callbacks.values()):
+            callback()
+
+    def has(self, key):
+        return key in self.values
+
+    def add_on_change(self, tag, callback):
+        self.callbacks[tag] = callback
+
+    def clear_on_change(self, tag):
+        self.callbacks.pop(tag, None)
+
+
+plugin_settings = {}
+status_messages = []
+
+
+def load_settings(name):
+    if name not in plugin_settings:
+        plugin_settings[name] = Settings()
+    return plugin_settings[name]
+
+
+def status_message(message):
+    status_messages.append(message)
+
+
+def set_timeout(callback, delay=0):
+    callback()
+
+
+def set_timeout_async(callback, delay=0):
+    callback()
+
+
+class Selection(list):
+
+    def add(self, region):
+        self.append(region)
+
+    def clear(self):
+        del self[:]
+
+
+class View(object):
+
+    view_ids = iter(range(1, 1 << 30))
+
+    def __init__(self, text, scope='source.python', settings=None):
+        self.text          = text
+        self.scope         = scope
+        self.view_settings = Settings(settings)
+        self.selection     = Selection()
+        self.changes       = 0
+        self.view_id       = next(View.view_ids)
+        self.line_starts   = None
+
+    def get_line_starts(self):
+        # index the line starts lazily as edits are applied in batches
+        if self.line_starts is None:
+            self.line_starts = [0]
+            pos              = self.text.find('\n')
+            while pos != -1:
+                self.line_starts.append(pos + 1)
+                pos = self.text.find('\n', pos + 1)
+        return self.line_starts
+
+    def id(self):
+        return self.view_id
+
+    def file_name(self):
+        return None
+
+    def name(self):
+        return ''
+
+    def size(self):
+        return len(self.text)
+
+    def settings(self):
+        return self.view_settings
+
+    def sel(self):
+        return self.selection
+
+    def change_count(self):
+        return self.changes
+
+    def scope_name(self, point):
+        return self.scope + ' '
+
+    def find_by_selector(self, selector):
+        # the whole text has the scope of the view
+        return [Region(0, len(self.text))] if self.scope.startswith(selector.split()[0]) else []
+
+    def rowcol(self, point):
+        line_starts = self.get_line_starts()
+        row         = bisect.bisect_right(line_starts, point) - 1
+        return row, point - line_starts[row]
+
+    def text_point(self, row, col):
+        line_starts = self.get_line_starts()
+        if row >= len(line_starts):
+            return len(self.text)
+        return min(line_starts[row] + col, len(self.text))
+
+    def line(self, x):
+        if isinstance(x, Region):
+            return Region(self.line(x.begin()).a, self.line(x.end()).b)
+        line_starts = self.get_line_starts()
+        row         = bisect.bisect_right(line_starts, x) - 1
+        end         = line_starts[row + 1] - 1 if row + 1 < len(line_starts) else len(self.text)
+        return Region(line_starts[row], end)
+
+    def substr(self, x):
+        if isinstance(x, Region):
+            return self.text[x.begin():x.end()]
+        return self.text[x:x + 1]
+
+    def replace(self, edit, region, text):
+        a, b             = region.begin(), region.end()
+        self.text        = self.text[:a] + text + self.text[b:]
+        self.changes    += 1
+        self.line_starts = None
+
+        # move selections behind the replaced region like Sublime Text does
+        for selection in self.selection:
+            selection.a = self.shift_point(selection.a, a, b, len(text))
+            selection.b = self.shift_point(selection.b, a, b, len(text))
+
+    def shift_point(self, point, a, b, insert_len):
+        if point >= b:
+            return point - (b - a) + insert_len
+        if point > a:
+            return a + insert_len
+        return point
+
+    def insert(self, edit, point, text):
+        self.replace(edit, Region(point), text)
+        return len(text)
+
+    def erase(self, edit, region):
+        self.replace(edit, region, '')
@@ -0,0 +1,23 @@
+# in-memory replacement of the plugin base classes used by the plugin
+
+
+class TextCommand(object):
+
+    def __init__(self, view):
+        self.view = view
+
+
+class WindowCommand(object):
+
+    def __init__(self, window):
+        self.window = window
+
+
+class EventListener(object):
+    pass
+
+
+class ViewEventListener(object):
+
+    def __init__(self, view):
+        self.view = view
@@ -1,465 +1,743 @@
 import sublime
 import sublime_plugin
-import re
+import collections
+import copy
+import itertools
+import threading
+import time
+
+try:
+    from . import multialign_engine
+except (ImportError, ValueError, SystemError):
+    import multialign_engine
+
+
+# name of the plugin settings file
+SETTINGS_FILE = 'multiAlign.sublime-settings'
+
+# view settings which are part of a compiled rule set
+VIEW_SETTINGS = [
+    'multiAlign_break_at_empty_lines',
+    'multiAlign_break_at_non_matching_lines',
+    'multiAlign_align_all',
+    'multiAlign_align_chars'
+]
+
+# settings read by each invocation with their default values
+INVOCATION_SETTINGS = [
+    ('parallel_threshold', 20000),
+    ('parallel_workers',   1),
+    ('max_block_rows',     10000),
+    ('max_block_time',     1000),
+    ('async_threshold',    20000),
+    ('profile',            False),
+    ('profile_threshold',  100),
+    ('profile_output',     'console')
+]
+
+
+# number of profiled invocations kept in the history
+PROFILE_HISTORY_SIZE = 50
+
+# calls counted while profiling
+PROFILE_COUNTERS = ['get_line', 'regex', 'conditions', 'replace']
+
+# part of the async threshold which is searched around the cursors on the UI thread before
+# the search is moved to the background
+SYNC_SEARCH_PART = 10
+
+# most accurate clock available
+timer = multialign_engine.timer
+
+
+# rule tables keyed by (plugin settings revision, view settings revision), each table compiles
+# the rule sets of the scopes it is asked for
+rule_table_cache = {}
+
+# settings revisions which invalidate the rule tables
+revision_counter = itertools.count(1)
+plugin_revision  = [None]
+view_revisions   = {}
+
+# reports of the last profiled invocations
+profile_history = collections.deque(maxlen=PROFILE_HISTORY_SIZE)
+
+# alignments planned in the background by view id
+async_jobs  = {}
+job_counter = itertools.count(1)
+
+# matches of the rows aligned by the last invocation in each view, valid as long as the
+# buffer has not been changed by anything else than the alignment
+match_cache = {}
+
+# key of the hidden regions marking the rows changed since the last alignment on type
+DIRTY_ROWS_KEY = 'multiAlign_dirty_rows'
+
+# settings of the alignment on type with their default values, it is enabled by the first one
+ALIGN_ON_TYPE_SETTINGS = [
+    ('align_on_type',          False),
+    ('align_on_type_delay',    500),
+    ('align_on_type_max_time', 50)
+]
+
+# state of the alignment on type by view id
+align_on_type_states = {}
+
+
+def get_view_settings_values(view_settings):
+    return [view_settings.get(setting) for setting in VIEW_SETTINGS]
+
+
+def on_plugin_settings_change():
+    plugin_revision[0] = next(revision_counter)
+    rule_table_cache.clear()
+
+
+def on_view_settings_change(view_id):
+    view_revision = view_revisions.get(view_id)
+    if view_revision:
+        # ignore changes of view settings not used by the plugin
+        values = get_view_settings_values(view_revision['settings'])
+        if values != view_revision['values']:
+            drop_rule_tables(view_revision['revision'])
+            view_revision['revision'] = next(revision_counter)
+            view_revision['values']   = values
+
+
+def drop_rule_tables(revision):
+    for key in [key for key in rule_table_cache if key[1] == revision]:
+        del rule_table_cache[key]
+
+
+def get_plugin_revision():
+    if plugin_revision[0] is None:
+        sublime.load_settings(SETTINGS_FILE).add_on_change('multiAlign', on_plugin_settings_change)
+        plugin_revision[0] = next(revision_counter)
+    return plugin_revision[0]
+
+
+def get_view_revision(view):
+    view_id = view.id()
+    if view_id not in view_revisions:
+        view_settings = view.settings()
+        view_settings.add_on_change('multiAlign', lambda: on_view_settings_change(view_id))
+        view_revisions[view_id] = {
+            'settings': view_settings,
+            'values':   get_view_settings_values(view_settings),
+            'revision': next(revision_counter)
+        }
+    return view_revisions[view_id]['revision']
+
+
+def cancel_async_job(view_id):
+    job = async_jobs.pop(view_id, None)
+    if job:
+        job['cancel_event'].set()
+    return bool(job)
+
+
+def forget_view(view_id):
+    cancel_async_job(view_id)
+    match_cache.pop(view_id, None)
+    align_on_type_states.pop(view_id, None)
+    view_revision = view_revisions.pop(view_id, None)
+    if view_revision:
+        view_revision['settings'].clear_on_change('multiAlign')
+        drop_rule_tables(view_revision['revision'])
+
+
+def plugin_unloaded():
+    if plugin_revision[0] is not None:
+        sublime.load_settings(SETTINGS_FILE).clear_on_change('multiAlign')
+    for view_id in list(view_revisions):
+        forget_view(view_id)
+    for view_id in list(async_jobs):
+        cancel_async_job(view_id)
+    match_cache.clear()
+    align_on_type_states.clear()
+
+
+def load_plugin_settings(view, settings):
+    view_settings   = view.settings()
+    plugin_settings = sublime.load_settings(SETTINGS_FILE)
+
+    # read settings from plugin setting file, view or set default values
+    return dict((setting, plugin_settings.get(setting, view_settings.get('multiAlign_' + setting, default))) for setting, default in settings)
+
+
+def mark_dirty_rows(view):
+    if not load_plugin_settings(view, ALIGN_ON_TYPE_SETTINGS[:1])['align_on_type']:
+        return
+    state = align_on_type_states.setdefault(view.id(), {
+        'modification_cnt':     0,
+        'aligning':             False,
+        'aligned_change_count': None
+    })
+
+    # ignore the alignment itself and undone changes to keep the alignment undoable
+    if state['aligning'] or view.change_count() == state['aligned_change_count'] or view.command_history(1)[0]:
+        return
+    settings = load_plugin_settings(view, ALIGN_ON_TYPE_SETTINGS[1:])
+
+    # mark the rows of the cursors by hidden regions at the beginning of the rows, which are
+    # moved along with the text by Sublime Text when rows above them are added or removed
+    dirty_points = set(region.a for region in view.get_regions(DIRTY_ROWS_KEY))
+    dirty_points.update(view.line(region.b).a for region in view.sel())
+    view.add_regions(DIRTY_ROWS_KEY, [sublime.Region(point) for point in sorted(dirty_points)], '', '', sublime.HIDDEN)
+
+    # align once no further changes have been made during the delay
+    state['modification_cnt'] += 1
+    modification_cnt            = state['modification_cnt']
+    max_time                    = settings['align_on_type_max_time']
+    sublime.set_timeout(lambda: align_dirty_rows(view, modification_cnt, max_time), settings['align_on_type_delay'])
+
+
+def align_dirty_rows(view, modification_cnt, max_time):
+    state = align_on_type_states.get(view.id())
+    if not state or modification_cnt != state['modification_cnt']:
+        return
+    # the command keeps the rows of blocks which have not been aligned in time marked
+    rows = sorted(set(view.rowcol(region.a)[0] for region in view.get_regions(DIRTY_ROWS_KEY)))
+    if rows:
+        state['aligning'] = True
+        try:
+            view.run_command('multialign_align_rows', {'rows': rows, 'max_time': max_time})
+        finally:
+            state['aligning'] = False
+        state['aligned_change_count'] = view.change_count()
+
+
+class Profiler(object):
+
+    def __init__(self, start):
+        self.start    = start
+        self.stages   = []
+        self.counters = collections.OrderedDict((counter, 0) for counter in PROFILE_COUNTERS)
+
+    def run_stage(self, stage, func, *args):
+        start = timer()
+        try:
+            return func(*args)
+        finally:
+            self.stages.append((stage, timer() - start))
+
+    def count(self, obj, method_name, counter):
+        # replace the method of the object by a method counting its calls
+        method = getattr(obj, method_name)
+
+        def counted_method(*args, **kwargs):
+            self.counters[counter] += 1
+            return method(*args, **kwargs)
+        setattr(obj, method_name, counted_method)
+
+    def get_report(self, name, line_cnt):
+        return {
+            'name':     name,
+            'lines':    line_cnt,
+            'time':     time.time(),
+            'total':    timer() - self.start,
+            'stages':   self.stages,
+            'counters': list(self.counters.items())
+        }
+
+
+def format_profile_report(report):
+    stages   = ', '.join('{0} {1:.1f}'.format(stage, duration * 1000) for stage, duration in report['stages'])
+    counters = ', '.join('{0} {1}'.format(counter, cnt) for counter, cnt in report['counters'])
+    return 'multiAlign: {0:.1f} ms for {1} ({2} lines) - {3} - {4}'.format(report['total'] * 1000, report['name'], report['lines'] + 1, stages, counters)
+
+
+class multialignListener(sublime_plugin.EventListener):
+
+    def on_close(self, view):
+        forget_view(view.id())
+
+    def on_modified(self, view):
+        # plans of alignments running in the background cannot be applied to the changed text anymore
+        if view.id() in async_jobs:
+            cancel_async_job(view.id())
+        if not view.settings().get('is_widget'):
+            mark_dirty_rows(view)
 
 
 class multialignCommand(sublime_plugin.TextCommand):
 
-    def load_settings(self):
-        view_settings   = self.view.settings()
-        plugin_settings = sublime.load_settings('multiAlign.sublime-settings')
+    def load_invocation_settings(self):
+        view_settings = self.view.settings()
 
-        # read settings from view
+        # read tab settings from view
         self.tab_size                 = int(view_settings.get('tab_size', 4))
         self.translate_tabs_to_spaces = view_settings.get('translate_tabs_to_spaces')
 
+        for setting, value in load_plugin_settings(self.view, INVOCATION_SETTINGS).items():
+            setattr(self, setting, value)
+
+    def load_settings(self):
+        view_settings   = self.view.settings()
+        plugin_settings = sublime.load_settings(SETTINGS_FILE)
+
         # read settings from plugin setting file, view or set default values
         self.break_at_empty_lines        = plugin_settings.get('break_at_empty_lines', view_settings.get('multiAlign_break_at_empty_lines', True))
         self.break_at_non_matching_lines = plugin_settings.get('break_at_non_matching_lines', view_settings.get('multiAlign_break_at_non_matching_lines', True))
-        self.align_chars                 = plugin_settings.get('align_chars',
-            view_settings.get('multiAlign_align_chars', [
-                {
-                    'char':            ' import ',
-                    'alignment':       'right',
-                    'spaces_left':     0,
-                    'spaces_right':    0,
-                    'is_in_scope':     ['source.python'],
-                    'is_left_of_char': ['from ']
-                },
-                {
-                    'char':            ' as ',
-                    'alignment':       'right',
-                    'spaces_left':     0,
-                    'spaces_right':    0,
-                    'is_in_scope':     ['source.python'],
-                    'is_left_of_char': ['import ']
-                },
-                {
-                    'char':         '#',
-                    'alignment':    'right',
-                    'spaces_left':  3,
-                    'spaces_right': 1,
-                    'is_in_scope':  ['source.python']
-                },
-                {
-                    'char':         '::',
-                    'alignment':    'right',
-                    'spaces_left':  1,
-                    'spaces_right': 1,
-                    'is_in_scope':  ['source.modern-fortran', 'source.fixedform-fortran']
-                },
-                {
-                    'char':             ' intent',
-                    'alignment':        'right',
-                    'spaces_left':      0,
-                    'spaces_right':     0,
-                    'is_in_scope':      ['source.modern-fortran', 'source.fixedform-fortran'],
-                    'is_right_of_char': ['::']
-                },
-                {
-                    'char':         '&',
-                    'alignment':    'right',
-                    'spaces_left':  1,
-                    'spaces_right': 0,
-                    'is_in_scope':  ['source.modern-fortran', 'source.fixedform-fortran']
-                },
-                {
-                    'char':         '=>',
-                    'alignment':    'right',
-                    'spaces_left':  1,
-                    'spaces_right': 1
-                },
-                {
-                    'char':            '=',
-                    'alignment':       'right',
-                    'spaces_left':     1,
-                    'spaces_right':    1,
-                    'prefixes':        ['+', '-', '*', '/', '.', '%', '<', '>', '!', '=', '~', '&', '|'],
-                    'not_enclosed_by': ['()', '[]']
-                },
-                {
-                    'char':            ':',
-                    'alignment':       'left',
-                    'spaces_left':     0,
-                    'spaces_right':    1,
-                    'not_enclosed_by': ['[]']
-                }
-            ])
-        )
-
-    def set_defaults_for_missing_settings(self):
-        default_settings = {
-            'alignment':         'right',
-            'spaces_left':       1,
-            'spaces_right':      1,
-            'prefixes':          [],
-            'is_in_scope':       [],
-            'not_in_scope':      [],
-            'not_enclosed_by':   [],
-            'not_left_of_char':  [],
-            'not_right_of_char': [],
-            'is_enclosed_by':    [],
-            'is_left_of_char':   [],
-            'is_right_of_char':  []
+        self.align_all                   = plugin_settings.get('align_all', view_settings.get('multiAlign_align_all', False))
+        self.align_chars                 = plugin_settings.get('align_chars', view_settings.get('multiAlign_align_chars', multialign_engine.DEFAULT_ALIGN_CHARS))
+
+    def load_rule_table(self):
+        key = (get_plugin_revision(), get_view_revision(self.view))
+
+        # parse settings only if no rule table is cached, regex objects are compiled by the
+        # table once for each distinct scope name
+        if key not in rule_table_cache:
+            self.load_settings()
+            rule_table_cache[key] = multialign_engine.RuleTable(
+                self.align_chars,
+                self.break_at_empty_lines,
+                self.break_at_non_matching_lines,
+                self.align_all
+            )
+        self.rule_table = rule_table_cache[key]
+
+    def get_rule_set(self, point):
+        return self.rule_table.get_rule_set(self.view.scope_name(point).strip())
+
+    def group_selections(self):
+        # selections in different scopes (e.g. embedded languages) are aligned with the rule sets of
+        # their scopes, the first selection of each group is its main row
+        start_rows_by_rule_set = collections.OrderedDict()
+        for region in self.selection:
+            start_rows_by_rule_set.setdefault(self.get_rule_set(region.begin()), []).append(self.view.rowcol(region.begin())[0])
+        self.rule_sets        = list(start_rows_by_rule_set.keys())
+        self.start_row_groups = list(start_rows_by_rule_set.values())
+        self.start_rows       = [row for start_rows in self.start_row_groups for row in start_rows]
+
+    def load_rule_sets(self):
+        self.load_rule_table()
+        self.rule_set = self.get_rule_set(self.selection[0].begin())
+        if not self.all_blocks:
+            self.group_selections()
+
+    def get_row_rule_set(self, row):
+        # scope at the first character of the row which is not a whitespace
+        line = self.snapshot.get_line(row)
+        return self.get_rule_set(self.snapshot.get_point(row) + len(line) - len(line.lstrip()))
+
+    def get_rule_sets_by_row(self):
+        # rows at which the rule set may change are the first rows of the blocks and the rows at which
+        # the scopes selected by the alignment characters begin or end (e.g. code blocks in Markdown)
+        view = self.view
+        rows = set()
+        for first_row, last_row in self.row_ranges:
+            for block_first_row, block_last_row in multialign_engine.find_blocks(self.snapshot, first_row, last_row, self.rule_set.break_at_empty_lines):
+                rows.add(block_first_row)
+        for selector in self.rule_table.selectors:
+            for region in view.find_by_selector(selector):
+                begin_row = view.rowcol(region.begin())[0]
+                end_row   = view.rowcol(region.end())[0]
+                rows.update((begin_row, end_row, end_row + 1))
+
+        # look up the rule set once for each of these rows and keep the rows from which on another
+        # rule set applies, blocks are split at these rows
+        rule_sets_by_row = {}
+        rule_set         = None
+        for first_row, last_row in self.row_ranges:
+            for row in sorted(row for row in rows if first_row <= row <= last_row):
+                row_rule_set = self.get_first_rule_set(row, last_row)
+                if row_rule_set is not None and row_rule_set is not rule_set:
+                    rule_sets_by_row[row] = row_rule_set
+                    rule_set              = row_rule_set
+        return rule_sets_by_row
+
+    def get_first_rule_set(self, first_row, last_row):
+        # rule set of the first non-empty row of the rows
+        for row in range(first_row, last_row + 1):
+            if self.snapshot.get_indent(row) is not None:
+                return self.get_row_rule_set(row)
+        return None
+
+    def create_engine(self, rule_set, first_row, last_row):
+        engine = multialign_engine.AlignmentEngine(rule_set, self.snapshot, first_row, last_row)
+        if self.align_all_arg is not None:
+            engine.align_all = self.align_all_arg
+        engine.max_block_rows = self.max_block_rows
+        engine.max_block_time = self.max_block_time / 1000.0
+        engine.cancel_event   = self.cancel_event
+        return engine
+
+    def read_rows(self, first_row, last_row):
+        view   = self.view
+        region = sublime.Region(view.text_point(first_row, 0), view.line(view.text_point(last_row, 0)).b)
+        return region.a, view.substr(region)
+
+    def replace(self, edit, region, text):
+        if self.profiler:
+            self.profiler.counters['replace'] += 1
+        self.view.replace(edit, region, text)
+
+    def apply_edit_plan(self, edit, edit_plan):
+        view = self.view
+        if not edit_plan:
+            return
+
+        # keep selections at their position relative to the text around them
+        selections = [(region.a, region.b) for region in view.sel()]
+        selections = multialign_engine.map_points(edit_plan, [point for selection in selections for point in selection])
+
+        # replace each group of nearby edits at once beginning at the end of the buffer
+        for edit_group in reversed(multialign_engine.group_edit_plan(edit_plan)):
+            region = sublime.Region(edit_group[0][0], edit_group[-1][0] + edit_group[-1][1])
+            if len(edit_group) == 1:
+                self.replace(edit, region, edit_group[0][2])
+                continue
+
+            text  = view.substr(region)
+            parts = []
+            pos   = region.a
+            for point, delete_len, insert_text in edit_group:
+                parts.append(text[pos - region.a:point - region.a])
+                parts.append(insert_text)
+                pos = point + delete_len
+            self.replace(edit, region, ''.join(parts))
+
+        view.sel().clear()
+        for i in range(0, len(selections), 2):
+            view.sel().add(sublime.Region(selections[i], selections[i + 1]))
+
+    def apply_alignment(self, edit):
+        # blocks of selections in different scopes never share rows
+        aligned_lines = {}
+        for engine in self.engines:
+            aligned_lines.update(engine.aligned_lines)
+        self.apply_edit_plan(edit, multialign_engine.get_edit_plan(self.snapshot, aligned_lines))
+
+    def get_row_ranges(self):
+        # rows of all selected lines or of the whole buffer if nothing is selected
+        view   = self.view
+        ranges = []
+        for region in self.selection:
+            if region.empty():
+                continue
+            first_row            = view.rowcol(region.begin())[0]
+            last_row, end_column = view.rowcol(region.end())
+
+            # full line selections end at the beginning of the next row
+            if end_column == 0 and last_row > first_row:
+                last_row -= 1
+            if ranges and first_row <= ranges[-1][1] + 1:
+                ranges[-1][1] = max(ranges[-1][1], last_row)
+            else:
+                ranges.append([first_row, last_row])
+        return ranges or [[0, self.line_cnt]]
+
+    def get_processes(self, row_cnt):
+        # small ranges are aligned faster than worker processes can be started
+        default_processes = multialign_engine.get_default_processes()
+        if row_cnt < self.parallel_threshold or default_processes == 1:
+            return 1
+        return self.parallel_workers or default_processes
+
+    def plan_blocks(self):
+        aligned_lines = {}
+        for first_row, last_row in self.row_ranges:
+            processes = self.get_processes(last_row - first_row + 1)
+            aligned_lines.update(multialign_engine.align_range(self.rule_set, self.snapshot, first_row, last_row, self.align_all_blocks, processes, self.cancel_event, self.rule_sets_by_row))
+        self.edit_plan = multialign_engine.get_edit_plan(self.snapshot, aligned_lines)
+
+    def run_stage(self, stage, func, *args):
+        if self.profiler:
+            return self.profiler.run_stage(stage, func, *args)
+        return func(*args)
+
+    def start_profiler(self, start):
+        # the profiler is started once the settings telling whether to profile have been loaded
+        self.profiler = Profiler(start) if self.profile else None
+        if self.profiler:
+            self.profiler.stages.append(('settings', timer() - start))
+
+    def count_calls(self, engines=()):
+        # blocks aligned by align_range are only covered by the line counter
+        self.profiler.count(self.snapshot, 'get_line', 'get_line')
+        for engine in engines:
+            self.profiler.count(engine, 'get_match_objects', 'regex')
+            self.profiler.count(engine, 'search_align_char', 'regex')
+            self.profiler.count(engine, 'evaluate_condition', 'conditions')
+
+    def report_profile(self):
+        report = self.profiler.get_report(self.view.file_name() or self.view.name() or 'untitled', self.line_cnt)
+        profile_history.append(report)
+
+        # report slow invocations only
+        if report['total'] * 1000 < self.profile_threshold:
+            return
+        if self.profile_output == 'status':
+            sublime.status_message(format_profile_report(report))
+        else:
+            print(format_profile_report(report))
+
+    def report_truncation(self):
+        truncated = [engine.truncated for engine in self.engines]
+        if 'rows' in truncated:
+            sublime.status_message('multiAlign: blocks limited to {0} rows above and below the cursors (max_block_rows)'.format(self.max_block_rows))
+        elif 'time' in truncated:
+            sublime.status_message('multiAlign: block search stopped after {0} ms (max_block_time)'.format(self.max_block_time))
+
+    def get_match_cache_key(self):
+        # the cached matches are only valid for the same rules, settings and selections
+        selections = tuple((region.a, region.b) for region in self.selection)
+        return (tuple(self.rule_sets), self.tab_size, self.translate_tabs_to_spaces, self.align_all_arg, self.max_block_rows, self.max_block_time, selections)
+
+    def load_cached_matches(self):
+        # positions of the cached matches have been moved along with the alignment of the last invocation
+        cached_matches = match_cache.pop(self.view.id(), None)
+        if cached_matches and cached_matches['change_count'] == self.view.change_count() and cached_matches['key'] == self.get_match_cache_key():
+            return cached_matches['align_chars_by_row']
+        return None
+
+    def store_cached_matches(self):
+        # blocks cut off by the limits are searched again by the next invocation
+        if any(engine.truncated for engine in self.engines):
+            return
+        match_cache[self.view.id()] = {
+            'key':                self.get_match_cache_key(),
+            'change_count':       self.view.change_count(),
+            'align_chars_by_row': [engine.align_chars_by_row for engine in self.engines]
         }
-        valid_align_chars = []
-        for align_char in self.align_chars:
-            # skip alignment characters without 'char' setting
-            if 'char' in align_char:
-                # set default values for missing settings
-                for setting in default_settings:
-                    if setting not in align_char:
-                        align_char[setting] = default_settings[setting]
-                valid_align_chars.append(align_char)
-        self.align_chars = valid_align_chars
-
-    def compile_regex_objects(self):
-        regex_string = ''
-        for align_char in self.align_chars:
-            # add logical or if more than one alignment character is configured
-            if regex_string and regex_string[-1] != '|':
-                regex_string += '|'
-
-            # compile regex for alignment character
-            align_char_regex_string      = self.get_regex_string(align_char)
-            align_char['compiled_regex'] = re.compile(align_char_regex_string)
-
-            # add alignment character
-            regex_string += align_char_regex_string
-
-        # compile regex for all alignment characters
-        self.regex_align_chars = re.compile(regex_string)
-
-        # compile regex for line indentation
-        self.regex_indentation = re.compile('^(\s*)\S')
-
-    def get_regex_string(self, align_char):
-        if align_char['is_in_scope'] and self.scope not in align_char['is_in_scope']:
-            regex_string = '(^$)'
-        elif align_char['not_in_scope'] and self.scope in align_char['not_in_scope']:
-            regex_string = '(^$)'
+
+    def get_planned_rows(self):
+        # rows the alignment may read, blocks around cursors can only reach beyond the
+        # limit of the block search by one row which reports the truncation
+        if self.all_blocks:
+            return self.row_ranges[0][0], self.row_ranges[-1][1]
+        if not self.max_block_rows or self.cached_matches is not None:
+            return 0, self.line_cnt
+        return max(0, min(self.start_rows) - self.max_block_rows - 1), min(self.line_cnt, max(self.start_rows) + self.max_block_rows + 1)
+
+    def read_snapshot(self, first_row, last_row):
+        # read all rows at once into an immutable snapshot which does not access the view anymore
+        chunk_first_row = first_row - first_row % multialign_engine.LINE_CHUNK_SIZE
+        chunk_last_row  = min(last_row - last_row % multialign_engine.LINE_CHUNK_SIZE + multialign_engine.LINE_CHUNK_SIZE - 1, self.line_cnt)
+        point, text     = self.read_rows(chunk_first_row, chunk_last_row)
+        read_rows       = multialign_engine.read_rows_from_lines(text.split('\n'), chunk_first_row, point)
+        return multialign_engine.LineSnapshot(read_rows, self.line_cnt, self.tab_size, self.translate_tabs_to_spaces)
+
+    def can_run_async(self):
+        return bool(self.async_threshold) and hasattr(sublime, 'set_timeout_async')
+
+    def is_async(self, row_cnt):
+        return self.can_run_async() and row_cnt >= self.async_threshold
+
+    def prepare_alignment(self, run_async, first_row, last_row):
+        if run_async:
+            self.snapshot = self.read_snapshot(first_row, last_row)
         else:
-            regex_string = '(\s*)('
-            # add prefixes
-            if align_char['prefixes']:
-                regex_string += '([{0:s}]?)'.format(''.join([re.escape(prefix) for prefix in align_char['prefixes']]))
-
-            # add alignment character
-            regex_string += re.escape(align_char['char'])
-            if align_char['alignment'] == 'left':
-                regex_string += ')(\s*)'
-            else:
-                regex_string += ')()'
-        return regex_string
-
-    def get_match_objects(self, row):
-        return list(self.regex_align_chars.finditer(self.get_line(row)))
-
-    def get_match_object_groups(self, match_obj):
-        return [element for element in match_obj.groups() if element is not None]
-
-    def get_match_objects_for_main_row(self):
-        self.align_chars_main_row = self.get_align_chars(self.main_row, is_main_row=True)
-
-    def get_align_chars(self, row, is_main_row=False):
-        def is_enclosed_by(char_list):
-            enclose_level = 0
-            for enclose_char in char_list:
-                char_left     = enclose_char[0]
-                char_right    = enclose_char[1]
-                if char_left != char_right:
-                    regex_string = '{0:s}|{1:s}'.format(re.escape(char_left), re.escape(char_right))
-                    for match_obj in re.finditer(regex_string, line):
-                        if match_obj.start() < align_char_start:
-                            if match_obj.group(0) == char_left:
-                                enclose_level += 1
-                            elif match_obj.group(0) == char_right:
-                                enclose_level -= 1
-                        else:
-                            break
-                else:
-                    if is_left_of_char([char_left]) and is_right_of_char([char_right]):
-                        enclose_level = 1
-                if enclose_level != 0:
-                    break
-            return enclose_level != 0
-
-        def is_left_of_char(char_list):
-            result       = False
-            regex_string = '|'.join([re.escape(char) for char in char_list])
-            match_obj    = re.search(regex_string, line)
-            if match_obj:
-                if match_obj.start() < align_char_start:
-                    result = True
-            return result
-
-        def is_right_of_char(char_list):
-            result = False
-            regex_string = '(?:{0:s})(?=(?:[^{1:s}])*$)'.format('|'.join([re.escape(char) for char in char_list]), '])|(?:[^'.join(['][^'.join(re.escape(char)) for char in char_list]))
-            match_obj = re.search(regex_string, line)
-            if match_obj:
-                if match_obj.start() > align_char_start:
-                    result = True
-            return result
-
-        align_chars = []
-        line        = self.get_line(row)
-        for match_obj in self.get_match_objects(row):
-            match_obj_groups          = self.get_match_object_groups(match_obj)
-            if len(match_obj_groups) >= 3:
-                for align_char in self.align_chars:
-                    if align_char['compiled_regex'].search(match_obj_groups[1]):
-                        cnt_spaces_left  = len(match_obj_groups[0])
-                        cnt_align_char   = len(match_obj_groups[1])
-                        align_char_start = match_obj.start() + cnt_spaces_left
-
-                        # skip detected alignment character if any of the checks fails
-                        if align_char['not_enclosed_by']:
-                            if is_enclosed_by(align_char['not_enclosed_by']):
-                                continue
-                        if align_char['not_left_of_char']:
-                            if is_left_of_char(align_char['not_left_of_char']):
-                                continue
-                        if align_char['not_right_of_char']:
-                            if is_right_of_char(align_char['not_right_of_char']):
-                                continue
-                        if align_char['is_enclosed_by']:
-                            if not is_enclosed_by(align_char['is_enclosed_by']):
-                                continue
-                        if align_char['is_left_of_char']:
-                            if not is_left_of_char(align_char['is_left_of_char']):
-                                continue
-                        if align_char['is_right_of_char']:
-                            if not is_right_of_char(align_char['is_right_of_char']):
-                                continue
-
-                        # add detected alignment character to the list
-                        if match_obj.start() == 0:
-                            target_pos = cnt_spaces_left + cnt_align_char
-                        else:
-                            target_pos = match_obj.start() + align_char['spaces_left'] + cnt_align_char
-
-                        if is_main_row:
-                            # store match_obj, corresponding align_char and checking parameters
-                            align_chars.append({
-                                'align_char':           align_char,
-                                'target_pos':           target_pos,
-                                'alignment_required':   False,
-                                'match_objects_by_row': {}
-                            })
-                        else:
-                            # store match_obj and corresponding align_char
-                            align_chars.append({
-                                'align_char': align_char,
-                                'match_obj':  match_obj,
-                                'target_pos': target_pos
-                            })
-                        break
-        return align_chars
-
-    def get_line(self, row):
-        view       = self.view
-        text_point = view.text_point(row, 0)
-        line       = view.line(text_point)
-        return view.substr(line).replace('\t', ' ' * self.tab_size)
-
-    def get_indent(self, row):
-        match_obj = self.regex_indentation.search(self.get_line(row))
-        if match_obj:
-            if self.translate_tabs_to_spaces:
-                indent = int(len(match_obj.group(1)) / self.tab_size)
-            else:
-                indent = len(match_obj.group(1))
+            self.snapshot = multialign_engine.LineSnapshot(self.read_rows, self.line_cnt, self.tab_size, self.translate_tabs_to_spaces)
+
+        # scopes are looked up on the UI thread before the alignment is planned
+        if self.all_blocks:
+            self.rule_sets_by_row = self.run_stage('scopes', self.get_rule_sets_by_row)
+        else:
+            self.engines = [self.create_engine(rule_set, first_row, last_row) for rule_set in self.rule_sets]
+            if self.cached_matches is not None:
+                for engine, align_chars_by_row in zip(self.engines, self.cached_matches):
+                    engine.align_chars_by_row = align_chars_by_row
+        if self.profiler:
+            self.count_calls(() if self.all_blocks else self.engines)
+
+    def search_blocks(self):
+        self.run_stage('main_row', self.get_match_objects_for_main_rows)
+        if self.cached_matches is None:
+            self.run_stage('find_matches', self.find_matches)
+
+    def is_search_too_large(self):
+        # search the blocks around the cursors on the UI thread as long as they are small, the rows
+        # searched are kept few as they are searched again in the background otherwise
+        for engine in self.engines:
+            engine.max_rows = max(1, self.async_threshold // SYNC_SEARCH_PART)
+        self.search_blocks()
+        return any(engine.truncated == 'size' for engine in self.engines)
+
+    def plan_alignment(self):
+        # the alignment is planned off the UI thread for large ranges and must not access the view
+        if self.all_blocks:
+            self.run_stage('align_blocks', self.plan_blocks)
+            return
+
+        if not self.blocks_searched:
+            self.search_blocks()
+        self.run_stage('check', self.check_alignments)
+
+    def get_match_objects_for_main_rows(self):
+        for engine, start_rows in zip(self.engines, self.start_row_groups):
+            engine.get_match_objects_for_main_row(start_rows[0])
+
+    def find_matches(self):
+        # rows of blocks found for selections in other scopes are not searched again
+        done_rows = set()
+        for engine, start_rows in zip(self.engines, self.start_row_groups):
+            engine.done_rows = done_rows
+            engine.find_matches_in_all_selections([row for row in start_rows if row not in done_rows])
+            done_rows.update(engine.get_rows())
+
+    def check_alignments(self):
+        for engine in self.engines:
+            engine.check_alignment_to_be_made()
+
+    def finish_alignment(self, edit):
+        if self.all_blocks:
+            self.run_stage('apply', self.apply_edit_plan, edit, self.edit_plan)
+        else:
+            self.report_truncation()
+            self.run_stage('apply', self.apply_alignment, edit)
+            self.store_cached_matches()
+
+        if self.profiler:
+            self.report_profile()
+
+    def start_async_job(self):
+        # plan with a copy of the command as the instance is reused by the next invocation in the view
+        job = {
+            'id':           next(job_counter),
+            'command':      copy.copy(self),
+            'change_count': self.view.change_count(),
+            'cancel_event': self.cancel_event
+        }
+        async_jobs[self.view.id()] = job
+        sublime.status_message('multiAlign: aligning in the background')
+        sublime.set_timeout_async(lambda: run_async_job(job), 0)
+
+    def run(self, edit, align_all=None, all_blocks=False):
+        cancel_async_job(self.view.id())
+        start = timer()
+        self.load_invocation_settings()
+        self.start_profiler(start)
+        self.selection     = self.view.sel()
+        self.line_cnt      = self.view.rowcol(self.view.size())[0]
+        self.all_blocks    = all_blocks
+        self.align_all_arg = align_all
+        self.cancel_event  = threading.Event()
+
+        self.run_stage('rule_set', self.load_rule_sets)
+        self.blocks_searched = False
+        if all_blocks:
+            self.row_ranges       = self.get_row_ranges()
+            self.align_all_blocks = True if align_all is None else align_all
+            run_async             = self.is_async(sum(last_row - first_row + 1 for first_row, last_row in self.row_ranges))
         else:
-            indent = None
-        return indent
-
-    def find_matches_in_all_selections(self):
-        self.align_chars_by_row = []
-
-        # loop through all selections beginning at the start row of each selection
-        for select in self.selection:
-            start_row   = self.view.rowcol(self.view.lines(select)[0].a)[0]
-            align_chars = self.get_align_chars(start_row)
-
-            # add match objects for start row of selection
-            if align_chars:
-                self.align_chars_by_row.append({
-                    'row':         start_row,
-                    'start_row':   start_row,
-                    'direction':   0,
-                    'align_chars': align_chars
-                })
-
-                # get indent of start_row
-                start_indent = self.get_indent(start_row)
-
-                # check lines above and below start_row
-                for direction in [-1, 1]:
-                    row = start_row + direction
-                    while 0 <= row and row <= self.line_cnt:
-                        # get indent of current row
-                        indent = self.get_indent(row)
-
-                        # handle empty line
-                        if indent is None:
-                            if self.break_at_empty_lines:
-                                break
-                            else:
-                                row += direction
-                                continue
-
-                        # handle indent change
-                        elif indent != start_indent:
-                            break
-
-                        align_chars = self.get_align_chars(row)
-                        align_chars_checked = []
-
-                        # check if align_chars match align_chars_main_row
-                        if align_chars:
-                            for i, main_align_char in enumerate(self.align_chars_main_row):
-                                if len(align_chars) > i:
-                                    if align_chars[i]['align_char']['char'] == main_align_char['align_char']['char']:
-                                        align_chars_checked.append(align_chars[i])
-                                    else:
-                                        break
-
-                        # add match objects for current row
-                        if align_chars_checked:
-                            self.align_chars_by_row.append({
-                                'row':         row,
-                                'start_row':   start_row,
-                                'direction':   direction,
-                                'align_chars': align_chars_checked
-                            })
-
-                        # skip all lines following in that direction
-                        elif self.break_at_non_matching_lines:
-                            break
-
-                        # next row
-                        row += direction
-
-    def find_max_target_positions(self):
-        for i, main_align_char in enumerate(self.align_chars_main_row):
-            for row_obj in self.align_chars_by_row:
-                if len(row_obj['align_chars']) > i:
-                    align_char = row_obj['align_chars'][i]
-                    if align_char['align_char']['char'] == main_align_char['align_char']['char']:
-                        if main_align_char['target_pos'] < align_char['target_pos']:
-                            main_align_char['target_pos'] = align_char['target_pos']
-
-    def check_alignment_to_be_made(self):
-        break_at = {}
-        for i, main_align_char in enumerate(self.align_chars_main_row):
-            main_alignment    = main_align_char['align_char']['alignment']
-            main_spaces_left  = main_align_char['align_char']['spaces_left']
-            main_spaces_right = main_align_char['align_char']['spaces_right']
-            main_target_pos   = main_align_char['target_pos']
-            for row_obj in self.align_chars_by_row:
-                row       = row_obj['row']
-                start_row = row_obj['start_row']
-                direction = row_obj['direction']
-                if len(row_obj['align_chars']) > i:
-                    align_char = row_obj['align_chars'][i]
-                    if self.break_at_non_matching_lines and start_row in break_at:
-                        if direction == break_at[start_row]['in_direction']:
-                            if row * direction > break_at[start_row]['from_row'] * break_at[start_row]['in_direction']:
-                                break
-                    if align_char['align_char']['char'] == main_align_char['align_char']['char']:
-                        # add match object to main alignment character dict
-                        match_obj = align_char['match_obj']
-                        main_align_char['match_objects_by_row'][row] = match_obj
-
-                        if main_alignment == 'left':
-                            # check if alignment is already in target position
-                            if match_obj.end() != main_target_pos + main_spaces_right:
-                                main_align_char['alignment_required'] = True
-
-                            # check if number of spaces left of alignment character is correct
-                            new_match_obj = re.search('^(\s*)\S', self.get_line(row)[match_obj.start():])
-                            if new_match_obj:
-                                if len(new_match_obj.group(1)) != main_spaces_left:
-                                    main_align_char['alignment_required'] = True
-
-                        else:
-                            # check if alignment is already in target position
-                            if match_obj.end() != main_target_pos:
-                                main_align_char['alignment_required'] = True
-
-                            # check if number of spaces right of alignment character is correct
-                            new_match_obj = re.search('^(\s*)\S', self.get_line(row)[main_target_pos:])
-                            if new_match_obj:
-                                if len(new_match_obj.group(1)) != main_spaces_right:
-                                    main_align_char['alignment_required'] = True
-
-                    # skip rows if alignment characters order is different
-                    elif self.break_at_non_matching_lines:
-                        if start_row not in break_at:
-                            break_at[start_row] = {}
-                        break_at[start_row]['from_row']     = row
-                        break_at[start_row]['in_direction'] = direction
-
-            # skip checking other characters
-            if main_align_char['alignment_required']:
+            self.cached_matches = self.load_cached_matches()
+            run_async           = False
+        first_row, last_row = self.get_planned_rows()
+        self.prepare_alignment(run_async, first_row, last_row)
+
+        # blocks around the cursors are only searched again in the background if the search has
+        # to check more rows than a part of the async threshold
+        if not all_blocks and self.cached_matches is None and self.can_run_async():
+            run_async = self.is_search_too_large()
+            if run_async:
+                self.prepare_alignment(run_async, first_row, last_row)
+            else:
+                self.blocks_searched = True
+
+        if run_async:
+            self.start_async_job()
+            return
+        self.plan_alignment()
+        self.finish_alignment(edit)
+
+
+class multialignAlignRowsCommand(multialignCommand):
+
+    def run(self, edit, rows, max_time=50):
+        # align all alignment characters of the blocks containing the rows without reading any
+        # other rows, blocks which cannot be checked within the time limit are left unchanged and
+        # their rows stay marked as dirty rows for the next alignment
+        self.profiler      = None
+        self.line_cnt      = self.view.rowcol(self.view.size())[0]
+        self.align_all_arg = True
+        self.cancel_event  = None
+        self.load_invocation_settings()
+        self.load_rule_table()
+        self.snapshot = multialign_engine.LineSnapshot(self.read_rows, self.line_cnt, self.tab_size, self.translate_tabs_to_spaces)
+
+        # spaces typed at the end of the rows of the cursors are kept for the next characters
+        cursor_rows   = set(self.view.rowcol(region.b)[0] for region in self.view.sel())
+        deadline      = timer() + max_time / 1000.0
+        aligned_lines = {}
+        done_rows     = set()
+        pending_rows  = []
+        for i, row in enumerate(rows):
+            if row in done_rows or row > self.line_cnt or self.snapshot.get_indent(row) is None:
+                continue
+            max_block_time = deadline - timer()
+            if max_block_time <= 0:
+                pending_rows = rows[i:]
                 break
 
-    def apply_alignment(self, edit):
-        for i, main_align_char in enumerate(self.align_chars_main_row):
-            if main_align_char['alignment_required']:
-                main_alignment    = main_align_char['align_char']['alignment']
-                main_spaces_left  = main_align_char['align_char']['spaces_left']
-                main_spaces_right = main_align_char['align_char']['spaces_right']
-                main_target_pos   = main_align_char['target_pos']
-
-                for row in main_align_char['match_objects_by_row']:
-                    match_obj        = main_align_char['match_objects_by_row'][row]
-                    match_obj_groups = self.get_match_object_groups(match_obj)
-                    cnt_align_char   = len(match_obj_groups[1])
-                    line             = self.get_line(row)
-                    i_start          = match_obj.start()
-                    i_end            = match_obj.end()
-
-                    if main_alignment == 'left':
-                        spaces_left  = main_spaces_left
-                        spaces_right = main_target_pos - i_start - cnt_align_char + main_spaces_right
-
-                    else:
-                        spaces_left  = main_target_pos - i_start - cnt_align_char
-                        spaces_right = main_spaces_right
-
-                    # do not add spaces at EOL
-                    if i_end == len(line):
-                        spaces_right = 0
-
-                    # align line
-                    aligned_line = ''.join([
-                        line[:i_start],
-                        ' ' * spaces_left,
-                        match_obj_groups[1],
-                        ' ' * spaces_right,
-                        line[i_end:].strip()
-                    ])
-
-                    # replace existing line with aligned line
-                    region = self.view.line(self.view.text_point(row, 0))
-                    self.view.replace(edit, region, aligned_line)
-
-                # leave loop after alignment
+            engine                      = self.create_engine(self.get_row_rule_set(row), 0, self.line_cnt)
+            engine.max_block_time       = max_block_time
+            engine.done_rows            = done_rows
+            engine.keep_trailing_spaces = cursor_rows
+            engine.get_match_objects_for_main_row(row)
+            if not engine.align_chars_main_row:
+                continue
+            engine.find_matches_in_all_selections([row])
+            if engine.truncated == 'time':
+                pending_rows = rows[i:]
                 break
+            if engine.truncated:
+                continue
+            engine.check_alignment_to_be_made()
+            if timer() > deadline:
+                pending_rows = rows[i:]
+                break
+            aligned_lines.update(engine.aligned_lines)
+            done_rows.update(engine.get_rows())
+        self.apply_edit_plan(edit, multialign_engine.get_edit_plan(self.snapshot, aligned_lines))
+
+        # the alignment does not add or remove rows, so the pending rows can be marked again by their row
+        dirty_regions = [sublime.Region(self.view.text_point(row, 0)) for row in pending_rows if row not in done_rows]
+        self.view.add_regions(DIRTY_ROWS_KEY, dirty_regions, '', '', sublime.HIDDEN)
+
+
+def run_async_job(job):
+    if job['cancel_event'].is_set():
+        return
+    job['command'].plan_alignment()
+
+    # apply the plan on the UI thread through a text command unless the job has been cancelled meanwhile
+    if not job['cancel_event'].is_set():
+        sublime.set_timeout(lambda: job['command'].view.run_command('multialign_apply_plan', {'job_id': job['id']}), 0)
+
+
+class multialignApplyPlanCommand(sublime_plugin.TextCommand):
+
+    def run(self, edit, job_id):
+        job = async_jobs.get(self.view.id())
+
+        # ignore plans of jobs which have been cancelled or replaced by a newer job
+        if not job or job['id'] != job_id:
+            return
+        del async_jobs[self.view.id()]
+        if self.view.change_count() != job['change_count']:
+            sublime.status_message('multiAlign: alignment discarded as the text has been changed meanwhile')
+            return
+        job['command'].finish_alignment(edit)
+
+
+class multialignCancelCommand(sublime_plugin.TextCommand):
 
     def run(self, edit):
-        self.selection = self.view.sel()
-        self.scope     = self.view.scope_name(self.selection[0].begin()).split()[0]
-        self.line_cnt  = self.view.rowcol(self.view.size())[0]
-        self.main_row  = self.view.rowcol(self.view.lines(self.selection[0])[0].a)[0]
-
-        self.load_settings()
-        self.set_defaults_for_missing_settings()
-        self.compile_regex_objects()
-        self.get_match_objects_for_main_row()
-        self.find_matches_in_all_selections()
-        self.find_max_target_positions()
-        self.check_alignment_to_be_made()
-        self.apply_alignment(edit)
+        if cancel_async_job(self.view.id()):
+            sublime.status_message('multiAlign: alignment cancelled')
+
+
+class multialignProfileCommand(sublime_plugin.WindowCommand):
+
+    def run(self):
+        # show the reports of the last profiled invocations in a new scratch view
+        view = self.window.new_file()
+        view.set_name('multiAlign profile')
+        view.set_scratch(True)
+        if profile_history:
+            text = '\n'.join(format_profile_report(report) for report in profile_history) + '\n'
+        else:
+            text = 'No profiled invocations. Enable the profile setting to record them.\n'
+        view.run_command('append', {'characters': text})
@@ -0,0 +1,1170 @@
+import argparse
+import array
+import bisect
+import collections
+import io
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+
+# number of rows read from the buffer with a single bulk substr
+LINE_CHUNK_SIZE = 256
+
+# edits closer than this number of characters are applied as one replacement
+EDIT_GROUP_GAP = 4096
+
+# maximum number of lines aligned at once when aligning streams
+MAX_BLOCK_LINES = 10000
+
+# minimum number of lines of the blocks sent to a worker process at once
+TASK_LINES = 2000
+
+# number of rows between checks of the time budget while searching blocks
+TIME_CHECK_ROWS = 64
+
+# scopes of file extensions used if no scope is given on the command line
+FILE_SCOPES = {
+    '.py':   'source.python',
+    '.pyw':  'source.python',
+    '.f':    'source.fixedform-fortran',
+    '.for':  'source.fixedform-fortran',
+    '.f77':  'source.fixedform-fortran',
+    '.f90':  'source.modern-fortran',
+    '.f95':  'source.modern-fortran',
+    '.f03':  'source.modern-fortran',
+    '.f08':  'source.modern-fortran',
+    '.json': 'source.json'
+}
+
+# regex for line indentation
+regex_indentation = re.compile(r'^(\s*)\S')
+
+# most accurate clock available
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def get_line_indent(line, tab_size, translate_tabs_to_spaces):
+    match_obj = regex_indentation.search(line)
+    if match_obj:
+        indent = len(match_obj.group(1).expandtabs(tab_size))
+        if translate_tabs_to_spaces:
+            return int(indent / tab_size)
+        return indent
+    return None
+
+
+def get_column_map(line, tab_size):
+    # visual column of each offset of the line, tabs advance to the next tab stop
+    if '\t' not in line:
+        return None
+    columns = array.array('l', [0]) * (len(line) + 1)
+    column  = 0
+    for i, char in enumerate(line):
+        columns[i] = column
+        if char == '\t':
+            column += tab_size - column % tab_size
+        else:
+            column += 1
+    columns[len(line)] = column
+    return columns
+
+
+class LineSnapshot(object):
+
+    def __init__(self, read_rows, line_cnt, tab_size, translate_tabs_to_spaces):
+        self.read_rows                = read_rows
+        self.line_cnt                 = line_cnt
+        self.tab_size                 = tab_size
+        self.translate_tabs_to_spaces = translate_tabs_to_spaces
+        self.raw_lines                = {}
+        self.columns                  = {}
+        self.indents                  = {}
+        self.points                   = {}
+
+    def load_chunk(self, row):
+        first_row   = row - row % LINE_CHUNK_SIZE
+        last_row    = min(first_row + LINE_CHUNK_SIZE - 1, self.line_cnt)
+        point, text = self.read_rows(first_row, last_row)
+
+        # read all rows of the chunk at once, columns and indents are determined on first use only
+        for i, raw_line in enumerate(text.split('\n')):
+            self.raw_lines[first_row + i] = raw_line
+            self.points[first_row + i]    = point
+            point                        += len(raw_line) + 1
+
+    def get_line(self, row):
+        if row not in self.raw_lines:
+            self.load_chunk(row)
+        return self.raw_lines[row]
+
+    def get_columns(self, row):
+        # lines without tabs have no column map as their offsets are their columns
+        if row not in self.columns:
+            self.columns[row] = get_column_map(self.get_line(row), self.tab_size)
+        return self.columns[row]
+
+    def get_indent(self, row):
+        if row not in self.indents:
+            self.indents[row] = get_line_indent(self.get_line(row), self.tab_size, self.translate_tabs_to_spaces)
+        return self.indents[row]
+
+    def get_point(self, row):
+        if row not in self.points:
+            self.load_chunk(row)
+        return self.points[row]
+
+
+def read_rows_from_lines(lines, first_row=0, first_point=0):
+    # points of the rows as if the lines were joined by line breaks, the lines may start at any row of a buffer
+    points = [first_point]
+    for line in lines:
+        points.append(points[-1] + len(line) + 1)
+
+    def read_rows(read_first_row, read_last_row):
+        return points[read_first_row - first_row], '\n'.join(lines[read_first_row - first_row:read_last_row - first_row + 1])
+    return read_rows
+
+
+def get_line_edit(point, line, aligned_line):
+    # restrict the edit to the part of the line which differs
+    max_len = min(len(line), len(aligned_line))
+    start   = 0
+    while start < max_len and line[start] == aligned_line[start]:
+        start += 1
+    end = 0
+    while end < max_len - start and line[-1 - end] == aligned_line[-1 - end]:
+        end += 1
+    return (point + start, len(line) - start - end, aligned_line[start:len(aligned_line) - end])
+
+
+def group_edit_plan(edit_plan):
+    groups = []
+    for edit in edit_plan:
+        if groups and edit[0] - (groups[-1][-1][0] + groups[-1][-1][1]) <= EDIT_GROUP_GAP:
+            groups[-1].append(edit)
+        else:
+            groups.append([edit])
+    return groups
+
+
+def map_points(edit_plan, points):
+    # position of each point after all edits of the (sorted) edit plan have been applied
+    edit_ends = []
+    shifts    = []
+    shift     = 0
+    for point, delete_len, insert_text in edit_plan:
+        shift += len(insert_text) - delete_len
+        edit_ends.append(point + delete_len)
+        shifts.append(shift)
+
+    mapped_points = []
+    for point in points:
+        i     = bisect.bisect_right(edit_ends, point)
+        shift = shifts[i - 1] if i else 0
+        if i < len(edit_plan) and edit_plan[i][0] < point:
+            # points within replaced text are moved to the end of the new text
+            point = edit_plan[i][0] + len(edit_plan[i][2])
+        mapped_points.append(point + shift)
+    return mapped_points
+
+
+class LeftOfCharMatcher(object):
+
+    def __init__(self, char_list):
+        self.char_list = [char for char in char_list if char]
+
+    def evaluate(self, line):
+        # position of the first character of the list in the line
+        positions = [line.find(char) for char in self.char_list]
+        positions = [pos for pos in positions if pos != -1]
+        return min(positions) if positions else None
+
+    def check(self, line_result, align_char_start):
+        return line_result is not None and line_result < align_char_start
+
+
+class RightOfCharMatcher(LeftOfCharMatcher):
+
+    def evaluate(self, line):
+        # position of the last character of the list in the line
+        positions = [line.rfind(char) for char in self.char_list]
+        positions = [pos for pos in positions if pos != -1]
+        return max(positions) if positions else None
+
+    def check(self, line_result, align_char_start):
+        return line_result is not None and line_result > align_char_start
+
+
+class EnclosedByMatcher(object):
+
+    def __init__(self, char_list):
+        # map each enclosing character to the level changes of the pairs it belongs to
+        self.pair_cnt = len(char_list)
+        self.tokens   = {}
+        for i, enclose_char in enumerate(char_list):
+            char_left  = enclose_char[0]
+            char_right = enclose_char[1]
+            if not char_left or not char_right:
+                continue
+            if char_left != char_right:
+                self.tokens.setdefault(char_left, []).append((i, 1))
+                self.tokens.setdefault(char_right, []).append((i, -1))
+            else:
+                self.tokens.setdefault(char_left, []).append((i, 0))
+
+        # match longer enclosing characters first
+        if self.tokens:
+            self.regex = re.compile('|'.join([re.escape(token) for token in sorted(self.tokens, key=len, reverse=True)]))
+        else:
+            self.regex = None
+
+    def evaluate(self, line):
+        # sweep the line once and flag every column where the enclose level of any pair is not zero
+        enclosed       = bytearray(len(line) + 1)
+        if not self.regex:
+            return enclosed
+        enclose_levels = [0] * self.pair_cnt
+        is_enclosed    = False
+        column         = 0
+        for match_obj in self.regex.finditer(line):
+            # the new enclose level applies right of the enclosing character
+            if is_enclosed:
+                enclosed[column:match_obj.start() + 1] = b'\x01' * (match_obj.start() + 1 - column)
+            column = match_obj.start() + 1
+
+            for i, level in self.tokens[match_obj.group(0)]:
+                if level:
+                    enclose_levels[i] += level
+                else:
+                    # identical opening and closing characters toggle the enclose level
+                    enclose_levels[i] = 1 - enclose_levels[i]
+            is_enclosed = any(enclose_levels)
+
+        if is_enclosed:
+            enclosed[column:] = b'\x01' * (len(enclosed) - column)
+        return enclosed
+
+    def check(self, line_result, align_char_start):
+        return bool(line_result[align_char_start])
+
+
+# conditions of alignment characters in the order they are checked
+CONDITIONS = [
+    ('not_enclosed_by',   EnclosedByMatcher,  False),
+    ('not_left_of_char',  LeftOfCharMatcher,  False),
+    ('not_right_of_char', RightOfCharMatcher, False),
+    ('is_enclosed_by',    EnclosedByMatcher,  True),
+    ('is_left_of_char',   LeftOfCharMatcher,  True),
+    ('is_right_of_char',  RightOfCharMatcher, True)
+]
+
+# condition matchers shared by all alignment characters with the same condition
+condition_matchers = {}
+
+
+def get_condition_matcher(matcher_class, char_list):
+    key = (matcher_class, tuple([tuple(char) for char in char_list]))
+    if key not in condition_matchers:
+        condition_matchers[key] = matcher_class(char_list)
+    return condition_matchers[key]
+
+
+# default alignment characters
+DEFAULT_ALIGN_CHARS = [
+    {
+        'char':            ' import ',
+        'alignment':       'right',
+        'spaces_left':     0,
+        'spaces_right':    0,
+        'is_in_scope':     ['source.python'],
+        'is_left_of_char': ['from ']
+    },
+    {
+        'char':            ' as ',
+        'alignment':       'right',
+        'spaces_left':     0,
+        'spaces_right':    0,
+        'is_in_scope':     ['source.python'],
+        'is_left_of_char': ['import ']
+    },
+    {
+        'char':         '#',
+        'alignment':    'right',
+        'spaces_left':  3,
+        'spaces_right': 1,
+        'is_in_scope':  ['source.python']
+    },
+    {
+        'char':         '::',
+        'alignment':    'right',
+        'spaces_left':  1,
+        'spaces_right': 1,
+        'is_in_scope':  ['source.modern-fortran', 'source.fixedform-fortran']
+    },
+    {
+        'char':             ' intent',
+        'alignment':        'right',
+        'spaces_left':      0,
+        'spaces_right':     0,
+        'is_in_scope':      ['source.modern-fortran', 'source.fixedform-fortran'],
+        'is_right_of_char': ['::']
+    },
+    {
+        'char':         '&',
+        'alignment':    'right',
+        'spaces_left':  1,
+        'spaces_right': 0,
+        'is_in_scope':  ['source.modern-fortran', 'source.fixedform-fortran']
+    },
+    {
+        'char':         '=>',
+        'alignment':    'right',
+        'spaces_left':  1,
+        'spaces_right': 1
+    },
+    {
+        'char':            '=',
+        'alignment':       'right',
+        'spaces_left':     1,
+        'spaces_right':    1,
+        'prefixes':        ['+', '-', '*', '/', '.', '%', '<', '>', '!', '=', '~', '&', '|'],
+        'not_enclosed_by': ['()', '[]']
+    },
+    {
+        'char':            ':',
+        'alignment':       'left',
+        'spaces_left':     0,
+        'spaces_right':    1,
+        'not_enclosed_by': ['[]']
+    }
+]
+
+# default values of missing alignment character settings
+DEFAULT_SETTINGS = {
+    'alignment':         'right',
+    'spaces_left':       1,
+    'spaces_right':      1,
+    'prefixes':          [],
+    'is_in_scope':       [],
+    'not_in_scope':      [],
+    'not_enclosed_by':   [],
+    'not_left_of_char':  [],
+    'not_right_of_char': [],
+    'is_enclosed_by':    [],
+    'is_left_of_char':   [],
+    'is_right_of_char':  []
+}
+
+
+class RuleSet(object):
+
+    def __init__(self, align_chars, scope, break_at_empty_lines=True, break_at_non_matching_lines=True, align_all=False):
+        self.align_chars                 = align_chars
+        self.scope                       = scope
+        self.break_at_empty_lines        = break_at_empty_lines
+        self.break_at_non_matching_lines = break_at_non_matching_lines
+        self.align_all                   = align_all
+
+        self.set_defaults_for_missing_settings()
+        self.compile_regex_objects()
+
+    def set_defaults_for_missing_settings(self):
+        valid_align_chars = []
+        for align_char in self.align_chars:
+            # skip alignment characters without 'char' setting
+            if 'char' in align_char:
+                # set default values for missing settings
+                align_char = dict(align_char)
+                for setting in DEFAULT_SETTINGS:
+                    if setting not in align_char:
+                        align_char[setting] = DEFAULT_SETTINGS[setting]
+                valid_align_chars.append(align_char)
+        self.align_chars = valid_align_chars
+
+    def compile_regex_objects(self):
+        regex_strings             = []
+        group_index               = 1
+        self.align_chars_by_group = {}
+
+        # drop alignment characters not applying to the current scope
+        self.align_chars = [align_char for align_char in self.align_chars if self.is_in_scope(align_char)]
+        for i, align_char in enumerate(self.align_chars):
+            # compile regex for alignment character
+            align_char_regex_string      = self.get_regex_string(align_char)
+            align_char['compiled_regex'] = re.compile(align_char_regex_string)
+            align_char['conditions']     = self.get_conditions(align_char)
+            align_char['index']          = i
+
+            # add alignment character as named group to identify it by the match object
+            align_char['group_name']  = 'c{0:d}'.format(i)
+            align_char['group_index'] = group_index
+            self.align_chars_by_group[align_char['group_name']] = align_char
+            regex_strings.append('(?P<{0:s}>{1:s})'.format(align_char['group_name'], align_char_regex_string))
+            group_index += 1 + align_char['compiled_regex'].groups
+
+        # compile regex for all alignment characters
+        if regex_strings:
+            self.regex_align_chars = re.compile('|'.join(regex_strings))
+        else:
+            self.regex_align_chars = None
+
+    def get_conditions(self, align_char):
+        conditions = []
+        for setting, matcher_class, expected in CONDITIONS:
+            if align_char[setting]:
+                conditions.append((get_condition_matcher(matcher_class, align_char[setting]), expected))
+        return conditions
+
+    def is_in_scope(self, align_char):
+        return is_in_scope(align_char, self.scope.split())
+
+    def get_regex_string(self, align_char):
+        regex_string = r'(\s*)('
+        # add prefixes
+        if align_char['prefixes']:
+            regex_string += '([{0:s}]?)'.format(''.join([re.escape(prefix) for prefix in align_char['prefixes']]))
+
+        # add alignment character
+        regex_string += re.escape(align_char['char'])
+        if align_char['alignment'] == 'left':
+            regex_string += r')(\s*)'
+        else:
+            regex_string += ')()'
+        return regex_string
+
+
+class RuleTable(object):
+
+    def __init__(self, align_chars, break_at_empty_lines=True, break_at_non_matching_lines=True, align_all=False):
+        self.align_chars                 = align_chars
+        self.break_at_empty_lines        = break_at_empty_lines
+        self.break_at_non_matching_lines = break_at_non_matching_lines
+        self.align_all                   = align_all
+
+        # rule sets by scope name and by the indices of the alignment characters they contain
+        self.rule_sets_by_scope   = {}
+        self.rule_sets_by_indices = {}
+        self.index_align_chars()
+
+    def index_align_chars(self):
+        # indices of the alignment characters by the scope selectors they are limited to
+        self.align_chars         = [dict(DEFAULT_SETTINGS, **align_char) for align_char in self.align_chars if 'char' in align_char]
+        self.unscoped_indices    = []
+        self.indices_by_selector = {}
+        self.selectors           = set()
+        for i, align_char in enumerate(self.align_chars):
+            if not align_char['is_in_scope']:
+                self.unscoped_indices.append(i)
+            for selector in align_char['is_in_scope']:
+                self.indices_by_selector.setdefault(selector, []).append(i)
+            self.selectors.update(align_char['is_in_scope'], align_char['not_in_scope'])
+
+    def get_rule_set(self, scope):
+        # compile each distinct combination of alignment characters only once
+        if scope not in self.rule_sets_by_scope:
+            scopes  = scope.split()
+            indices = set(self.unscoped_indices)
+            for selector in self.indices_by_selector:
+                if matches_scope(selector, scopes):
+                    indices.update(self.indices_by_selector[selector])
+            indices = tuple(i for i in sorted(indices) if is_in_scope(self.align_chars[i], scopes))
+
+            if indices not in self.rule_sets_by_indices:
+                self.rule_sets_by_indices[indices] = RuleSet(
+                    [self.align_chars[i] for i in indices],
+                    scope,
+                    self.break_at_empty_lines,
+                    self.break_at_non_matching_lines,
+                    self.align_all
+                )
+            self.rule_sets_by_scope[scope] = self.rule_sets_by_indices[indices]
+        return self.rule_sets_by_scope[scope]
+
+
+def matches_scope(selector, scopes):
+    # selectors match scopes of the scope name which are equal or more specific (e.g. source matches source.python)
+    for scope in scopes:
+        if scope == selector or scope.startswith(selector + '.'):
+            return True
+    return False
+
+
+def is_in_scope(align_char, scopes):
+    if align_char['is_in_scope'] and not any(matches_scope(selector, scopes) for selector in align_char['is_in_scope']):
+        return False
+    elif align_char['not_in_scope'] and any(matches_scope(selector, scopes) for selector in align_char['not_in_scope']):
+        return False
+    return True
+
+
+class AlignmentEngine(object):
+
+    def __init__(self, rule_set, snapshot, first_row=0, last_row=None, done_rows=None):
+        self.rule_set                    = rule_set
+        self.snapshot                    = snapshot
+        self.break_at_empty_lines        = rule_set.break_at_empty_lines
+        self.break_at_non_matching_lines = rule_set.break_at_non_matching_lines
+        self.align_all                   = rule_set.align_all
+        self.align_chars                 = rule_set.align_chars
+        self.align_chars_by_group        = rule_set.align_chars_by_group
+        self.regex_align_chars           = rule_set.regex_align_chars
+
+        # rows the blocks are limited to and rows already aligned as part of other blocks
+        self.first_row = first_row
+        self.last_row  = snapshot.line_cnt if last_row is None else last_row
+        self.done_rows = done_rows or set()
+
+        # limits of the block search (rows in each direction, rows checked in total, seconds and an
+        # event cancelling the search), truncated is set to 'rows', 'size', 'time' or 'cancelled'
+        # if a block has been cut off by them
+        self.max_block_rows = None
+        self.max_rows       = None
+        self.max_block_time = None
+        self.cancel_event   = None
+        self.deadline       = None
+        self.checked_rows   = 0
+        self.truncated      = None
+
+        # rows whose spaces at the end are kept (e.g. spaces just typed at a cursor)
+        self.keep_trailing_spaces = set()
+
+    def get_rows(self):
+        return [row_obj['row'] for row_obj in self.align_chars_by_row]
+
+    def check_conditions(self, align_char, line, line_results, align_char_start):
+        for matcher, expected in align_char['conditions']:
+            # evaluate each condition only once per line
+            if matcher not in line_results:
+                line_results[matcher] = self.evaluate_condition(matcher, line)
+            if matcher.check(line_results[matcher], align_char_start) != expected:
+                return False
+        return True
+
+    def evaluate_condition(self, matcher, line):
+        return matcher.evaluate(line)
+
+    def get_match_objects(self, row):
+        if self.regex_align_chars is None:
+            return []
+        return list(self.regex_align_chars.finditer(self.get_line(row)))
+
+    def get_match_object_groups(self, match_obj):
+        # groups of leading spaces, alignment character and trailing spaces of the matching alignment character
+        align_char  = self.align_chars_by_group[match_obj.lastgroup]
+        group_index = align_char['group_index']
+        return match_obj.group(group_index + 1, group_index + 2, group_index + align_char['compiled_regex'].groups)
+
+    def get_align_char_candidates(self, match_obj, align_char_text):
+        align_char = self.align_chars_by_group[match_obj.lastgroup]
+        yield align_char
+
+        # alignment characters configured later which match as well are used if the conditions fail
+        for other_align_char in self.align_chars[align_char['index'] + 1:]:
+            if self.search_align_char(other_align_char, align_char_text):
+                yield other_align_char
+
+    def search_align_char(self, align_char, text):
+        return align_char['compiled_regex'].search(text)
+
+    def get_match_objects_for_main_row(self, main_row):
+        self.align_chars_main_row = self.get_align_chars(main_row, is_main_row=True)
+
+    def get_align_chars(self, row, is_main_row=False):
+        align_chars  = []
+        line         = self.get_line(row)
+        columns      = self.snapshot.get_columns(row)
+        line_results = {}
+        for match_obj in self.get_match_objects(row):
+            match_obj_groups = self.get_match_object_groups(match_obj)
+            for align_char in self.get_align_char_candidates(match_obj, match_obj_groups[1]):
+                cnt_spaces_left  = len(match_obj_groups[0])
+                cnt_align_char   = len(match_obj_groups[1])
+                align_char_start = match_obj.start() + cnt_spaces_left
+
+                # skip detected alignment character if any of the checks fails
+                if not self.check_conditions(align_char, line, line_results, align_char_start):
+                    continue
+
+                # add detected alignment character to the list
+                target_pos = self.get_target_pos(align_char, match_obj.start(), align_char_start, cnt_align_char, columns)
+
+                if is_main_row:
+                    # store corresponding align_char and checking parameters
+                    align_chars.append({
+                        'align_char':         align_char,
+                        'target_pos':         target_pos,
+                        'alignment_required': False,
+                        'align_chars_by_row': {}
+                    })
+                else:
+                    # store position of the match and corresponding align_char
+                    align_chars.append({
+                        'align_char': align_char,
+                        'text':       match_obj_groups[1],
+                        'start':      match_obj.start(),
+                        'char_start': align_char_start,
+                        'end':        match_obj.end(),
+                        'target_pos': target_pos
+                    })
+                break
+        return align_chars
+
+    def get_target_pos(self, align_char, start, char_start, cnt_align_char, columns):
+        # target positions are visual columns while all other positions are offsets in the line
+        if columns is not None:
+            start      = columns[start]
+            char_start = columns[char_start]
+
+        # keep spaces left of alignment characters at the beginning of the line
+        if start == 0:
+            return char_start + cnt_align_char
+        return start + align_char['spaces_left'] + cnt_align_char
+
+    def get_line(self, row):
+        return self.snapshot.get_line(row)
+
+    def get_indent(self, row):
+        return self.snapshot.get_indent(row)
+
+    def get_aligned_line(self, row):
+        if row in self.aligned_lines:
+            return self.aligned_lines[row]
+        return self.get_line(row)
+
+    def get_aligned_columns(self, row):
+        if row not in self.aligned_lines:
+            return self.snapshot.get_columns(row)
+        if row not in self.aligned_columns:
+            self.aligned_columns[row] = get_column_map(self.aligned_lines[row], self.snapshot.tab_size)
+        return self.aligned_columns[row]
+
+    def get_aligned_column(self, row, pos):
+        columns = self.get_aligned_columns(row)
+        return pos if columns is None else columns[pos]
+
+    def get_spaces_width(self, row, pos):
+        # visual width of the whitespace at the position unless it reaches the end of the line
+        match_obj = regex_indentation.search(self.get_aligned_line(row)[pos:])
+        if not match_obj:
+            return None
+        return self.get_aligned_column(row, pos + len(match_obj.group(1))) - self.get_aligned_column(row, pos)
+
+    def is_block_limit_reached(self, start_row, row):
+        if self.max_block_rows and abs(row - start_row) > self.max_block_rows:
+            self.truncated = self.truncated or 'rows'
+            return True
+        self.checked_rows += 1
+        if self.max_rows and self.checked_rows > self.max_rows:
+            self.truncated = 'size'
+
+        # the clock and the cancel event are only checked every few rows as they are slow compared to a single row
+        if self.truncated in ('size', 'time', 'cancelled'):
+            return True
+        if row % TIME_CHECK_ROWS == 0:
+            if self.cancel_event is not None and self.cancel_event.is_set():
+                self.truncated = 'cancelled'
+            elif self.deadline is not None and timer() > self.deadline:
+                self.truncated = 'time'
+        return self.truncated in ('time', 'cancelled')
+
+    def find_matches_in_all_selections(self, start_rows):
+        self.align_chars_by_row = []
+        self.checked_rows       = 0
+        visited_rows            = set()
+        if self.max_block_time:
+            self.deadline = timer() + self.max_block_time
+
+        # loop through all selections beginning at the start row of each selection
+        for start_row in start_rows:
+            # selections in blocks which have already been discovered are part of these blocks
+            if start_row in visited_rows:
+                continue
+            align_chars = self.get_align_chars(start_row)
+
+            # add match objects for start row of selection
+            if align_chars:
+                visited_rows.add(start_row)
+                self.align_chars_by_row.append({
+                    'row':         start_row,
+                    'start_row':   start_row,
+                    'direction':   0,
+                    'align_chars': align_chars
+                })
+
+                # get indent of start_row
+                start_indent = self.get_indent(start_row)
+
+                # check lines above and below start_row
+                for direction in [-1, 1]:
+                    row = start_row + direction
+                    while self.first_row <= row and row <= self.last_row:
+                        # rows of other blocks and the limits of the block search end the block, rows
+                        # already visited from another selection continue a block discovered before
+                        if row in self.done_rows or row in visited_rows or self.is_block_limit_reached(start_row, row):
+                            break
+
+                        # get indent of current row
+                        indent = self.get_indent(row)
+
+                        # handle empty line
+                        if indent is None:
+                            if self.break_at_empty_lines:
+                                break
+                            else:
+                                row += direction
+                                continue
+
+                        # handle indent change
+                        elif indent != start_indent:
+                            break
+
+                        align_chars = self.get_align_chars(row)
+                        align_chars_checked = []
+
+                        # check if align_chars match align_chars_main_row
+                        if align_chars:
+                            for i, main_align_char in enumerate(self.align_chars_main_row):
+                                if len(align_chars) > i:
+                                    if align_chars[i]['align_char']['char'] == main_align_char['align_char']['char']:
+                                        align_chars_checked.append(align_chars[i])
+                                    else:
+                                        break
+
+                        # add match objects for current row
+                        if align_chars_checked:
+                            visited_rows.add(row)
+                            self.align_chars_by_row.append({
+                                'row':         row,
+                                'start_row':   start_row,
+                                'direction':   direction,
+                                'align_chars': align_chars_checked
+                            })
+
+                        # skip all lines following in that direction
+                        elif self.break_at_non_matching_lines:
+                            break
+
+                        # next row
+                        row += direction
+
+    def find_max_target_position(self, i):
+        # alignment characters left of this one might have been moved by the alignment
+        main_align_char               = self.align_chars_main_row[i]
+        main_align_char['target_pos'] = 0
+        for row_obj in self.align_chars_by_row:
+            if len(row_obj['align_chars']) > i:
+                align_char = row_obj['align_chars'][i]
+                if align_char['align_char']['char'] == main_align_char['align_char']['char']:
+                    if main_align_char['target_pos'] < align_char['target_pos']:
+                        main_align_char['target_pos'] = align_char['target_pos']
+
+    def check_alignment_to_be_made(self):
+        self.aligned_lines   = {}
+        self.aligned_columns = {}
+        self.row_objs        = {}
+        for row_obj in self.align_chars_by_row:
+            self.row_objs.setdefault(row_obj['row'], []).append(row_obj)
+
+        break_at = {}
+        for i, main_align_char in enumerate(self.align_chars_main_row):
+            self.find_max_target_position(i)
+            main_alignment    = main_align_char['align_char']['alignment']
+            main_spaces_left  = main_align_char['align_char']['spaces_left']
+            main_spaces_right = main_align_char['align_char']['spaces_right']
+            main_target_pos   = main_align_char['target_pos']
+            for row_obj in self.align_chars_by_row:
+                row       = row_obj['row']
+                start_row = row_obj['start_row']
+                direction = row_obj['direction']
+                if len(row_obj['align_chars']) > i:
+                    align_char = row_obj['align_chars'][i]
+                    if self.break_at_non_matching_lines and start_row in break_at:
+                        if direction == break_at[start_row]['in_direction']:
+                            if row * direction > break_at[start_row]['from_row'] * break_at[start_row]['in_direction']:
+                                break
+                    if align_char['align_char']['char'] == main_align_char['align_char']['char']:
+                        # add alignment character of the row to main alignment character dict
+                        main_align_char['align_chars_by_row'][row] = align_char
+
+                        if main_alignment == 'left':
+                            # check if alignment is already in target position
+                            if self.get_aligned_column(row, align_char['end']) != main_target_pos + main_spaces_right:
+                                main_align_char['alignment_required'] = True
+
+                            # check if number of spaces left of alignment character is correct
+                            spaces_width = self.get_spaces_width(row, align_char['start'])
+                            if spaces_width is not None and spaces_width != main_spaces_left:
+                                main_align_char['alignment_required'] = True
+
+                        else:
+                            # check if alignment is already in target position
+                            if self.get_aligned_column(row, align_char['end']) != main_target_pos:
+                                main_align_char['alignment_required'] = True
+
+                            # check if number of spaces right of alignment character is correct
+                            spaces_width = self.get_spaces_width(row, align_char['end'])
+                            if spaces_width is not None and spaces_width != main_spaces_right:
+                                main_align_char['alignment_required'] = True
+
+                    # skip rows if alignment characters order is different
+                    elif self.break_at_non_matching_lines:
+                        if start_row not in break_at:
+                            break_at[start_row] = {}
+                        break_at[start_row]['from_row']     = row
+                        break_at[start_row]['in_direction'] = direction
+
+            if main_align_char['alignment_required']:
+                self.align_column(main_align_char)
+
+                # skip checking other characters unless all of them get aligned at once
+                if not self.align_all:
+                    break
+
+    def align_column(self, main_align_char):
+        main_alignment    = main_align_char['align_char']['alignment']
+        main_spaces_left  = main_align_char['align_char']['spaces_left']
+        main_spaces_right = main_align_char['align_char']['spaces_right']
+        main_target_pos   = main_align_char['target_pos']
+
+        for row in sorted(main_align_char['align_chars_by_row']):
+            align_char     = main_align_char['align_chars_by_row'][row]
+            cnt_align_char = len(align_char['text'])
+            line           = self.get_aligned_line(row)
+            i_start        = align_char['start']
+            i_end          = align_char['end']
+            column_start   = self.get_aligned_column(row, i_start)
+
+            if main_alignment == 'left':
+                spaces_left  = main_spaces_left
+                spaces_right = main_target_pos - column_start - cnt_align_char + main_spaces_right
+
+            else:
+                spaces_left  = main_target_pos - column_start - cnt_align_char
+                spaces_right = main_spaces_right
+
+            # do not add spaces at EOL
+            if i_end == len(line):
+                spaces_right = 0
+
+            # align line
+            rest               = line[i_end:]
+            aligned_rest       = rest.strip()
+            aligned_line_start = ''.join([
+                line[:i_start],
+                ' ' * spaces_left,
+                align_char['text'],
+                ' ' * spaces_right
+            ])
+            if aligned_rest and row in self.keep_trailing_spaces:
+                aligned_rest += rest[len(rest.rstrip()):]
+            self.aligned_lines[row] = aligned_line_start + aligned_rest
+            self.aligned_columns.pop(row, None)
+
+            # move the alignment characters of the row to their new positions
+            self.shift_align_chars(row, align_char, spaces_left, spaces_right, len(line) - len(rest.lstrip()))
+
+    def shift_align_chars(self, row, aligned_char, spaces_left, spaces_right, rest_start):
+        aligned_line   = self.aligned_lines[row]
+        columns        = self.get_aligned_columns(row)
+        cnt_align_char = len(aligned_char['text'])
+        char_start     = aligned_char['char_start']
+        new_char_start = aligned_char['start'] + spaces_left
+        new_rest_start = new_char_start + cnt_align_char + spaces_right
+
+        def shift(pos):
+            if pos >= rest_start:
+                # stripped spaces at EOL are not part of the aligned line
+                return min(pos + new_rest_start - rest_start, len(aligned_line))
+            # positions in the replaced spaces are moved right of the aligned character
+            return new_char_start + cnt_align_char
+
+        for row_obj in self.row_objs[row]:
+            for align_char in row_obj['align_chars']:
+                if align_char['char_start'] == char_start:
+                    align_char['char_start'] = new_char_start
+                    align_char['end']        = new_char_start + cnt_align_char
+                    if align_char['align_char']['alignment'] == 'left':
+                        align_char['end'] = min(new_rest_start, len(aligned_line))
+                elif align_char['char_start'] > char_start:
+                    align_char['start']      = shift(align_char['start'])
+                    align_char['char_start'] = shift(align_char['char_start'])
+                    align_char['end']        = shift(align_char['end'])
+                else:
+                    continue
+                align_char['target_pos'] = self.get_target_pos(align_char['align_char'], align_char['start'], align_char['char_start'], len(align_char['text']), columns)
+
+
+def get_edit_plan(snapshot, aligned_lines):
+    # edits for all rows which have been changed by the alignment
+    edit_plan = []
+    for row in sorted(aligned_lines):
+        raw_line = snapshot.get_line(row)
+        if aligned_lines[row] != raw_line:
+            edit_plan.append(get_line_edit(snapshot.get_point(row), raw_line, aligned_lines[row]))
+    return edit_plan
+
+
+def align_range(rule_set, snapshot, first_row=0, last_row=None, align_all=True, processes=1, cancel_event=None, rule_sets_by_row=None):
+    # rule sets of other scopes can be given by the rows from which on they apply (e.g. embedded languages)
+    last_row = snapshot.line_cnt if last_row is None else last_row
+    blocks   = find_rule_set_blocks(rule_set, snapshot, first_row, last_row, rule_sets_by_row or {})
+    if processes > 1:
+        return align_range_parallel(snapshot, blocks, align_all, processes, cancel_event)
+
+    # align all blocks of the range beginning at the first row of each block
+    aligned_lines = {}
+    done_rows     = set()
+    for block_first_row, block_last_row, block_rule_set in blocks:
+        for row in range(block_first_row, block_last_row + 1):
+            if row in done_rows:
+                continue
+            if cancel_event is not None and cancel_event.is_set():
+                return aligned_lines
+            engine              = AlignmentEngine(block_rule_set, snapshot, row, block_last_row, done_rows)
+            engine.align_all    = align_all
+            engine.cancel_event = cancel_event
+            engine.get_match_objects_for_main_row(row)
+            if engine.align_chars_main_row:
+                engine.find_matches_in_all_selections([row])
+                engine.check_alignment_to_be_made()
+                aligned_lines.update(engine.aligned_lines)
+                done_rows.update(engine.get_rows())
+    return aligned_lines
+
+
+def align_range_parallel(snapshot, blocks, align_all, processes, cancel_event=None):
+    # independent blocks of the range are aligned by worker processes, separately for each rule set
+    blocks_by_rule_set = collections.OrderedDict()
+    for block_first_row, block_last_row, block_rule_set in blocks:
+        block_lines = [snapshot.get_line(row) for row in range(block_first_row, block_last_row + 1)]
+        blocks_by_rule_set.setdefault(block_rule_set, []).append((block_lines, block_first_row))
+
+    # the worker processes are shared by all rule sets
+    pool          = get_worker_pool(processes)
+    aligned_lines = {}
+    try:
+        for block_rule_set, rule_set_blocks in blocks_by_rule_set.items():
+            for lines, block_first_row in map_blocks(rule_set_blocks, block_rule_set, snapshot.tab_size, snapshot.translate_tabs_to_spaces, align_all, processes, pool):
+                if cancel_event is not None and cancel_event.is_set():
+                    return aligned_lines
+                for row, line in enumerate(lines, block_first_row):
+                    if line != snapshot.get_line(row):
+                        aligned_lines[row] = line
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return aligned_lines
+
+
+def align_lines(lines, rule_set, tab_size=4, translate_tabs_to_spaces=True, align_all=True):
+    snapshot      = LineSnapshot(read_rows_from_lines(lines), len(lines) - 1, tab_size, translate_tabs_to_spaces)
+    aligned_lines = align_range(rule_set, snapshot, align_all=align_all)
+    return [aligned_lines.get(row, line) for row, line in enumerate(lines)]
+
+
+def align_blocks(blocks, rule_set, tab_size, translate_tabs_to_spaces, align_all):
+    return [align_lines(lines, rule_set, tab_size, translate_tabs_to_spaces, align_all) for lines in blocks]
+
+
+def get_default_processes():
+    # worker processes are only started by forking as the executable of an embedding
+    # application (e.g. the Sublime Text plugin host) cannot be started as interpreter
+    if hasattr(multiprocessing, 'get_start_method'):
+        start_method = multiprocessing.get_start_method()
+    else:
+        start_method = 'fork' if os.name == 'posix' else 'spawn'
+    if start_method != 'fork':
+        return 1
+    return multiprocessing.cpu_count()
+
+
+def get_worker_pool(processes):
+    try:
+        return multiprocessing.Pool(processes)
+    except (ImportError, OSError):
+        return None
+
+
+def map_blocks(blocks, rule_set, tab_size, translate_tabs_to_spaces, align_all, processes=1, pool=None):
+    # align the lines of (lines, data) tuples and yield (aligned lines, data) tuples in the same order,
+    # a pool given by the caller is used instead of starting new worker processes and kept running
+    own_pool = pool is None
+    if own_pool and processes > 1:
+        pool = get_worker_pool(processes)
+    if pool is None:
+        for lines, data in blocks:
+            yield align_lines(lines, rule_set, tab_size, translate_tabs_to_spaces, align_all), data
+        return
+
+    try:
+        tasks = collections.deque()
+        for task in iter_tasks(blocks):
+            result = pool.apply_async(align_blocks, ([lines for lines, data in task], rule_set, tab_size, translate_tabs_to_spaces, align_all))
+            tasks.append(([data for lines, data in task], result))
+
+            # limit the number of blocks waiting to be aligned
+            while len(tasks) > 2 * processes:
+                data, result = tasks.popleft()
+                for aligned_block in zip(result.get(), data):
+                    yield aligned_block
+        while tasks:
+            data, result = tasks.popleft()
+            for aligned_block in zip(result.get(), data):
+                yield aligned_block
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
+
+
+def iter_tasks(blocks, task_lines=TASK_LINES):
+    # send multiple small blocks to a worker process at once
+    task     = []
+    task_cnt = 0
+    for block in blocks:
+        task.append(block)
+        task_cnt += len(block[0])
+        if task_cnt >= task_lines:
+            yield task
+            task     = []
+            task_cnt = 0
+    if task:
+        yield task
+
+
+def is_block_break(indent, block_indent, break_at_empty_lines):
+    # blocks end at empty lines or at changes of the indentation level
+    if indent is None:
+        return break_at_empty_lines
+    return block_indent is not None and indent != block_indent
+
+
+def find_rule_set_blocks(rule_set, snapshot, first_row, last_row, rule_sets_by_row):
+    # (first row, last row, rule set) of each block, blocks are split at the rows from which
+    # on another rule set applies
+    split_rows = sorted(rule_sets_by_row)
+    blocks     = []
+    for block_first_row, block_last_row in find_blocks(snapshot, first_row, last_row, rule_set.break_at_empty_lines):
+        i              = bisect.bisect_right(split_rows, block_first_row)
+        block_rule_set = rule_sets_by_row[split_rows[i - 1]] if i else rule_set
+        while i < len(split_rows) and split_rows[i] <= block_last_row:
+            blocks.append((block_first_row, split_rows[i] - 1, block_rule_set))
+            block_first_row = split_rows[i]
+            block_rule_set  = rule_sets_by_row[block_first_row]
+            i              += 1
+        blocks.append((block_first_row, block_last_row, block_rule_set))
+    return blocks
+
+
+def find_blocks(snapshot, first_row, last_row, break_at_empty_lines):
+    blocks       = []
+    block_indent = None
+    for row in range(first_row, last_row + 1):
+        indent = snapshot.get_indent(row)
+        if blocks and not is_block_break(indent, block_indent, break_at_empty_lines):
+            blocks[-1][1] = row
+        else:
+            blocks.append([row, row])
+            block_indent = None
+        if indent is not None:
+            block_indent = indent
+    return blocks
+
+
+def iter_blocks(input_file, rule_set, tab_size=4, translate_tabs_to_spaces=True, max_block_lines=MAX_BLOCK_LINES):
+    # split the stream into blocks which cannot be aligned with each other
+    lines        = []
+    line_ends    = []
+    block_indent = None
+    for raw_line in input_file:
+        line   = raw_line.rstrip('\r\n')
+        indent = get_line_indent(line, tab_size, translate_tabs_to_spaces)
+        if lines and ((max_block_lines and len(lines) >= max_block_lines) or is_block_break(indent, block_indent, rule_set.break_at_empty_lines)):
+            yield lines, line_ends
+            lines        = []
+            line_ends    = []
+            block_indent = None
+
+        # keep line endings to write them back unchanged
+        lines.append(line)
+        line_ends.append(raw_line[len(line):])
+        if indent is not None:
+            block_indent = indent
+    if lines:
+        yield lines, line_ends
+
+
+def align_stream(input_file, output_file, rule_set, tab_size=4, translate_tabs_to_spaces=True, align_all=True, processes=1, max_block_lines=MAX_BLOCK_LINES):
+    blocks = iter_blocks(input_file, rule_set, tab_size, translate_tabs_to_spaces, max_block_lines)
+    for lines, line_ends in map_blocks(blocks, rule_set, tab_size, translate_tabs_to_spaces, align_all, processes):
+        for line, line_end in zip(lines, line_ends):
+            output_file.write(line + line_end)
+
+
+def load_settings_file(path):
+    if not path:
+        return {}
+    with io.open(path, encoding='utf-8') as settings_file:
+        return json.load(settings_file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='multialign', description='Align files block by block with the multiAlign alignment characters.')
+    parser.add_argument('files', nargs='*', help='files to align, standard input is aligned to standard output if none are given')
+    parser.add_argument('-s', '--settings', help='JSON file with the plugin settings (break_at_empty_lines, align_chars, ...)')
+    parser.add_argument('--scope', help='scope of the input (default: derived from the file extension)')
+    parser.add_argument('--tab-size', type=int, default=4, help='number of spaces per tab (default: 4)')
+    parser.add_argument('--no-translate-tabs', dest='translate_tabs_to_spaces', action='store_false', help='indentation is made of tabs')
+    parser.add_argument('--stepwise', dest='align_all', action='store_false', help='align only the first alignment character which is not aligned in each block')
+    parser.add_argument('-i', '--in-place', action='store_true', help='write the aligned files back instead of printing them')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of worker processes aligning blocks in parallel, 0 for one per CPU (default: 1)')
+    parser.add_argument('--max-block-lines', type=int, default=MAX_BLOCK_LINES, help='number of lines after which blocks are split to limit the memory, 0 for no limit (default: {0})'.format(MAX_BLOCK_LINES))
+    parser.add_argument('--encoding', default='utf-8', help='encoding of the input and output (default: utf-8)')
+    args = parser.parse_args(argv)
+
+    settings   = load_settings_file(args.settings)
+    processes  = args.jobs or multiprocessing.cpu_count()
+    rule_table = RuleTable(
+        settings.get('align_chars', DEFAULT_ALIGN_CHARS),
+        settings.get('break_at_empty_lines', True),
+        settings.get('break_at_non_matching_lines', True),
+        settings.get('align_all', False)
+    )
+
+    def align(input_file, output_file, scope):
+        rule_set = rule_table.get_rule_set(scope)
+        align_stream(input_file, output_file, rule_set, args.tab_size, args.translate_tabs_to_spaces, args.align_all, processes, args.max_block_lines)
+
+    if not args.files:
+        input_file  = io.TextIOWrapper(sys.stdin.buffer, encoding=args.encoding, newline='')
+        output_file = io.TextIOWrapper(sys.stdout.buffer, encoding=args.encoding, newline='')
+        align(input_file, output_file, args.scope or '')
+        output_file.flush()
+        return 0
+
+    output_file = None
+    if not args.in_place:
+        output_file = io.TextIOWrapper(sys.stdout.buffer, encoding=args.encoding, newline='')
+    for path in args.files:
+        scope = args.scope or FILE_SCOPES.get(os.path.splitext(path)[1].lower(), '')
+        with io.open(path, encoding=args.encoding, newline='') as input_file:
+            if args.in_place:
+                # write to a temporary file next to the original file and replace it afterwards
+                with io.open(path + '.multialign', 'w', encoding=args.encoding, newline='') as aligned_file:
+                    align(input_file, aligned_file, scope)
+            else:
+                align(input_file, output_file, scope)
+        if args.in_place:
+            os.replace(path + '.multialign', path)
+    if output_file:
+        output_file.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+# regression tests of the editor-independent alignment engine and its command line interface
+#
+#     python -m pytest tests
+#
+# the expected output of the alignments is the output of the original plugin aligning the
+# same lines stepwise until nothing changes anymore
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+TEST_DIR     = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(TEST_DIR)]
+
+import multialign_engine
+
+
+def align(text, scope='source.python', align_all=True, tab_size=4, translate_tabs_to_spaces=True):
+    rule_set = multialign_engine.RuleSet(multialign_engine.DEFAULT_ALIGN_CHARS, scope)
+    return '\n'.join(multialign_engine.align_lines(text.split('\n'), rule_set, tab_size, translate_tabs_to_spaces, align_all))
+
+
+class AlignLinesTest(unittest.TestCase):
+
+    def test_assignments_and_comments(self):
+        text = (
+            'a = 1  # one\n'
+            'bbb = 22 # two\n'
+            'cc = 333  # three'
+        )
+        aligned = (
+            'a   = 1     # one\n'
+            'bbb = 22    # two\n'
+            'cc  = 333   # three'
+        )
+        self.assertEqual(align(text), aligned)
+
+    def test_stepwise(self):
+        text = (
+            'a = 1  # one\n'
+            'bbb = 22 # two'
+        )
+        aligned = (
+            'a   = 1  # one\n'
+            'bbb = 22 # two'
+        )
+        self.assertEqual(align(text, align_all=False), aligned)
+
+    def test_dict_keys(self):
+        text = (
+            'config = {\n'
+            '    \'a\': 1,\n'
+            '    \'bbb\':   2,\n'
+            '    \'cc\' : [1, 2],\n'
+            '}'
+        )
+        aligned = (
+            'config = {\n'
+            '    \'a\':   1,\n'
+            '    \'bbb\': 2,\n'
+            '    \'cc\':  [1, 2],\n'
+            '}'
+        )
+        self.assertEqual(align(text), aligned)
+
+    def test_not_enclosed_by(self):
+        text = (
+            'x = f(a=1)\n'
+            'long_name = g[b=2]'
+        )
+        aligned = (
+            'x         = f(a=1)\n'
+            'long_name = g[b=2]'
+        )
+        self.assertEqual(align(text), aligned)
+
+    def test_conditions(self):
+        text = (
+            'from os import path\n'
+            'from collections import OrderedDict as OD\n'
+            'from sys import exit as quit_'
+        )
+        aligned = (
+            'from os          import path\n'
+            'from collections import OrderedDict as OD\n'
+            'from sys         import exit as quit_'
+        )
+        self.assertEqual(align(text), aligned)
+
+    def test_scope(self):
+        text = (
+            'integer, intent(in) :: cnt\n'
+            'real,     intent(inout)   :: value\n'
+            'real(8) :: long_name'
+        )
+        aligned = (
+            'integer, intent(in)    :: cnt\n'
+            'real,    intent(inout) :: value\n'
+            'real(8) :: long_name'
+        )
+        self.assertEqual(align(text, 'source.modern-fortran'), aligned)
+
+    def test_other_scope(self):
+        text = (
+            'a = 1  # one\n'
+            'bbb = 22 # two'
+        )
+        aligned = (
+            'a   = 1  # one\n'
+            'bbb = 22 # two'
+        )
+        self.assertEqual(align(text, 'source.modern-fortran'), aligned)
+
+    def test_blocks(self):
+        text = (
+            'a = 1\n'
+            'bbb = 2\n'
+            '\n'
+            '    c = 3\n'
+            '    dddd = 4\n'
+            'e = 5'
+        )
+        aligned = (
+            'a   = 1\n'
+            'bbb = 2\n'
+            '\n'
+            '    c    = 3\n'
+            '    dddd = 4\n'
+            'e = 5'
+        )
+        self.assertEqual(align(text), aligned)
+
+
+class AlignStreamTest(unittest.TestCase):
+
+    def test_line_endings(self):
+        rule_set    = multialign_engine.RuleSet(multialign_engine.DEFAULT_ALIGN_CHARS, 'source.python')
+        input_file  = io.StringIO(u'a = 1\r\nbbb = 2\n\ncc = 3\r\ndddd = 4')
+        output_file = io.StringIO()
+        multialign_engine.align_stream(input_file, output_file, rule_set)
+        self.assertEqual(output_file.getvalue(), u'a   = 1\r\nbbb = 2\n\ncc   = 3\r\ndddd = 4')
+
+    def test_block_size(self):
+        rule_set    = multialign_engine.RuleSet(multialign_engine.DEFAULT_ALIGN_CHARS, 'source.python')
+        input_file  = io.StringIO(u'a = 1\nbbb = 2\ncc = 3\n')
+        output_file = io.StringIO()
+        multialign_engine.align_stream(input_file, output_file, rule_set, max_block_lines=2)
+        self.assertEqual(output_file.getvalue(), u'a   = 1\nbbb = 2\ncc = 3\n')
+
+        input_file  = io.StringIO(u'a = 1\nbbb = 2\ncc = 3\n')
+        output_file = io.StringIO()
+        multialign_engine.align_stream(input_file, output_file, rule_set, max_block_lines=0)
+        self.assertEqual(output_file.getvalue(), u'a   = 1\nbbb = 2\ncc  = 3\n')
+
+
+class MainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_in_place(self):
+        path = os.path.join(self.temp_dir, 'example.py')
+        with io.open(path, 'w', newline='') as example_file:
+            example_file.write(u'a = 1\r\nbbb = 2\r\n')
+        self.assertEqual(multialign_engine.main(['-i', path]), 0)
+        with io.open(path, newline='') as example_file:
+            self.assertEqual(example_file.read(), u'a   = 1\r\nbbb = 2\r\n')
+        self.assertEqual(os.listdir(self.temp_dir), ['example.py'])
+
+    def test_max_block_lines(self):
+        path = os.path.join(self.temp_dir, 'example.py')
+        with io.open(path, 'w', newline='') as example_file:
+            example_file.write(u'a = 1\nbbb = 2\ncc = 3\n')
+        self.assertEqual(multialign_engine.main(['-i', '--max-block-lines', '2', path]), 0)
+        with io.open(path, newline='') as example_file:
+            self.assertEqual(example_file.read(), u'a   = 1\nbbb = 2\ncc = 3\n')
+
+
+if __name__ == '__main__':
+    unittest.main()